@@ -1 +1 @@
-VERSION = '0.2.1'
+VERSION = '0.2.2'
@@ -1,7 +1,12 @@
+from downpour.core import startup
 from twisted.internet import reactor, defer, protocol, task
 from downpour.feed import checker
-from downpour.core import db, plugins, manager, models
-import sys, os, pwd, grp, logging, ConfigParser, atexit, traceback
+from downpour.core import db, plugins, manager, models, sqlitefk, maintenance
+from downpour.core.commit import CommitScheduler
+from downpour.core.events import EventBus
+from downpour.core.settings import SettingsService
+from downpour.core.dbaccess import DataAccess
+import sys, os, pwd, grp, logging, ConfigParser, atexit, traceback, urllib
 from storm.locals import Store, create_database
 
 class Application:
@@ -23,31 +28,42 @@ class Application:
     def __init__(self, options=None):
 
         self.store = None
+        self.database = None
+        self.committer = None
+        self.dataaccess = None
         self.manager = None
+        self.user_managers = {}
         self.plugins = []
 
         # Not a comprehensive list, just adding as I need them
-        self.listeners = {
-            'downpour_started': [],
-            'downpour_shutdown': [],
-            'downpour_paused': [],
-            'downpour_resumed': [],
-            'download_added': [],
-            'download_started': [],
-            'download_stopped': [],
-            'download_failed': [],
-            'download_complete': [],
-            'download_imported': [],
-            'download_import_failed': [],
-            'download_removed': [],
-            'feed_added': [],
-            'feed_updated': [],
-            'feed_removed': [],
-            'feed_item_added': [],
-            'feed_item_removed': [],
-            'library_file_added': [],
-            'library_file_removed': []
-        }
+        events = (
+            'downpour_started',
+            'downpour_shutdown',
+            'downpour_paused',
+            'downpour_resumed',
+            'download_added',
+            'download_started',
+            'download_stopped',
+            'download_failed',
+            'download_complete',
+            'download_imported',
+            'download_import_failed',
+            'download_removed',
+            'downloads_added',
+            'downloads_started',
+            'downloads_stopped',
+            'downloads_removed',
+            'feed_added',
+            'feed_updated',
+            'feed_removed',
+            'feed_item_added',
+            'feed_item_removed',
+            'library_file_added',
+            'library_file_removed',
+            'library_updated',
+            'user_updated',
+            'user_removed'
+        )
 
         # Load configuration from file
         config = Application.options['config']
@@ -82,6 +98,10 @@ class Application:
             level=loglevels[self.get_option(('downpour', 'log'), 'info')],
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+        self.events = EventBus(events,
+            self.get_option(('downpour', 'event_dispatch'), 'sync'),
+            int(self.get_option(('downpour', 'slow_listener'), 100)))
+
         if 'download' in options and 'work_directory' in options['download']:
             if not os.path.exists(options['download']['work_directory']):
                 try:
@@ -105,45 +125,65 @@ class Application:
     def get_class(self, kls):
         parts = kls.split('.')
         module = ".".join(parts[:-1])
-        m = __import__( module )
-        for comp in parts[1:]:
-            m = getattr(m, comp)            
-        return m
+        m = startup.report.import_module(module)
+        return getattr(m, parts[-1])
 
     def start(self):
 
         logging.info('Downpour started')
 
-        self.state = list(self.get_store().find(models.State))
-        self.settings = list(self.get_store().find(models.Setting))
-        self.manager = manager.GlobalManager(self)
+        # Initialization cost of each subsystem is recorded, see core.startup
+        report = startup.report
+        report.measure('database', self.get_store)
+        self.state = report.measure('state', SettingsService, self.get_store(), models.State)
+        self.settings = report.measure('settings', SettingsService, self.get_store(), models.Setting)
+        self.manager = report.measure('manager', manager.GlobalManager, self)
 
         # Initialize plugins
         for plugin in self.plugins:
             pn = '%s.%s' % (plugin.__class__.__module__, plugin.__class__.__name__)
             if pn in self.options:
-                plugin.setup(self.options[pn]);
+                report.measure(pn, plugin.setup, self.options[pn])
             else:
-                plugin.setup({});
+                report.measure(pn, plugin.setup, {})
+
+        # Resume downloads from previous session, see core.resume
+        report.measure('resume', self.manager.resume_session)
+
+        # Re-run the download queue whenever a slot may have opened up
+        for event in ('download_added', 'download_complete', 'download_failed',
+                'download_stopped', 'download_removed', 'downpour_resumed'):
+            self.add_event_listener(event, self.manager.schedule_auto_queue)
 
-        # Resume downloads from previous session
-        logging.info('Resuming previous downloads')
-        dl = [self.manager.start_download(d.id, True) \
-            for d in self.manager.get_downloads() if d.active]
-        self.wait_for_deferred(dl)
+        # Periodic queue check only as a safety net for missed events
+        interval = int(self.get_option(('downpour', 'queue_interval'), 300))
+        self.queue_checker = task.LoopingCall(self.auto_queue).start(interval, True)
 
-        # Start download queue checker
-        self.queue_checker = task.LoopingCall(self.auto_queue).start(30, True)
+        # Keep the write-ahead log short between automatic checkpoints
+        interval = int(self.get_option(('downpour', 'db_checkpoint_interval'), 300))
+        if interval:
+            self.db_checkpointer = task.LoopingCall(self.checkpoint_database).start(interval, False)
 
         # Start RSS feed checker
         self.feed_checker = task.LoopingCall(checker.check_feeds, self.manager).start(60, True)
         self.add_event_listener('download_imported', checker.clean_download_feed, self)
 
+        # Keep cached user managers current
+        for event in ('feed_added', 'feed_updated', 'feed_removed'):
+            self.add_event_listener(event, self.invalidate_managers, 'feeds')
+        self.add_event_listener('library_updated', self.invalidate_managers, 'libraries')
+        self.add_event_listener('user_updated', self.invalidate_managers,
+            'library_directory', 'downloads', 'feeds')
+        self.add_event_listener('user_removed', self.remove_manager)
+        self.state.subscribe(u'paused', self.paused_changed)
+
         # Start plugins
         for plugin in self.plugins:
-            plugin.start()
+            pn = '%s.%s' % (plugin.__class__.__module__, plugin.__class__.__name__)
+            report.measure('%s start' % pn, plugin.start)
 
         self.fire_event('downpour_started')
+        report.finish()
 
         # Shutdown handler
         atexit.register(self.stop)
@@ -160,11 +200,19 @@ class Application:
         return self.manager.resume();
 
     def stop(self):
+        self.manager.resumer.stop()
+
         # Wait for all pause tasks to stop
         dfl = self.manager.pause()
         self.wait_for_deferred(dfl)
 
         self.fire_event('downpour_shutdown')
+        self.events.flush()
+
+        # Write out any pending changes
+        self.manager.runtime.checkpoint_all()
+        self.get_commit_scheduler().flush()
+        self.get_data_access().stop()
 
         # Stop plugins
         for plugin in self.plugins:
@@ -204,90 +252,109 @@ class Application:
                 if not os.path.exists(db_dir):
                     os.makedirs(db_dir);
                 need_init = True
-            database = create_database('sqlite:%s' % db_path)
-            self.store = Store(database)
+            # Before the store holds a connection, see core.maintenance
+            try:
+                startup.report.measure('vacuum conversion',
+                    maintenance.enable_incremental_vacuum, db_path)
+            except Exception as e:
+                logging.error('Could not enable incremental vacuum: %s' % e)
+            # Connection profile and pragma overrides, see core.sqlitefk
+            dboptions = {'profile': self.get_option(('downpour', 'db_profile'), 'performance')}
+            for name in sqlitefk.pragmas:
+                value = self.get_option(('downpour', 'db_%s' % name))
+                if value is not None:
+                    dboptions[name] = value
+            self.database = create_database('sqlite:%s?%s' % (db_path, urllib.urlencode(dboptions)))
+            self.store = Store(self.database)
             if need_init:
                 db.initialize_db(self.store)
             db.upgrade_database(self)
         return self.store
 
+    def checkpoint_database(self):
+        try:
+            sqlitefk.checkpoint(os.path.expanduser(self.options['downpour']['state']))
+        except Exception as e:
+            logging.error('Database checkpoint failed: %s' % e)
+
+    # Off-reactor database access, see core.dbaccess
+    def get_data_access(self):
+        if not self.dataaccess:
+            self.get_store()
+            readers = int(self.get_option(('downpour', 'db_readers'), 2))
+            self.dataaccess = DataAccess(self.database, readers)
+        return self.dataaccess
+
+    def get_commit_scheduler(self):
+        if not self.committer:
+            interval = float(self.get_option(('downpour', 'commit_interval'), 0))
+            self.committer = CommitScheduler(self.get_store(), interval)
+        return self.committer
+
     def get_user(self, username, password):
         user = self.get_store().find(models.User,
             models.User.username == username,
             models.User.password == password).one()
         return user
 
+    # User managers are cached for the life of the application, their
+    # cached views are dropped by invalidate_managers()
     def get_manager(self, user=None):
         if user:
-            return manager.UserManager(self, user)
+            if not user.id in self.user_managers:
+                self.user_managers[user.id] = manager.UserManager(self, user)
+            um = self.user_managers[user.id]
+            um.user = user
+            return um
         return self.manager
 
+    # Event listener, invalidates cached views on the global manager and
+    # all user managers. The event's first argument is the changed
+    # object: if it is a User only that user's manager is affected.
+    def invalidate_managers(self, obj, *caches):
+        managers = self.user_managers.values() + [self.manager]
+        if isinstance(obj, models.User):
+            managers = [m for m in managers if m is not self.manager and m.user.id == obj.id]
+        for m in managers:
+            m.invalidate(*caches)
+
+    def remove_manager(self, user):
+        if user.id in self.user_managers:
+            self.user_managers[user.id].detach()
+            del self.user_managers[user.id]
+
+    def paused_changed(self, name, old_value, new_value):
+        # The global manager tracks its own state in pause() / resume()
+        for m in self.user_managers.values():
+            m.paused = (new_value == u'1')
+
     def get_option(self, option, default=None):
         if option[0] in self.options and option[1] in self.options[option[0]]:
             return self.options[option[0]][option[1]]
         return default
 
     def set_state(self, name, value):
-        state = None
-        for s in self.state:
-            if s.name == name:
-                state = s
-                break
-        if not state:
-            state = models.State()
-            state.name = name
-            self.state.append(state)
-            self.get_store().add(state)
-        state.value = unicode(value)
-        self.get_store().commit()
+        self.state.set(name, value)
 
     def get_state(self, name, default=None):
-        for s in self.state:
-            if s.name == name:
-                return s.value
-        return default
+        return self.state.get(name, default)
 
     def set_setting(self, name, value):
-        setting = None
-        for s in self.settings:
-            if s.name == name:
-                setting = s
-                break
-        if not setting:
-            setting = models.Setting()
-            setting.name = name
-            self.settings.append(setting)
-            self.get_store().add(setting)
-        setting.value = unicode(value)
-        self.get_store().commit()
+        self.settings.set(name, value)
 
     def get_setting(self, name, default=None):
-        for s in self.settings:
-            if s.name == name:
-                return s.value
-        return default
+        return self.settings.get(name, default)
 
     def is_paused(self):
         return self.get_state(u'paused', u'0') == u'1'
 
-    def add_event_listener(self, event, listener, *args):
-        if event in self.listeners:
-            self.listeners[event].append([listener, args])
+    # Pass threaded=True to run a blocking listener in the thread pool
+    def add_event_listener(self, event, listener, *args, **kwargs):
+        self.events.add_listener(event, listener, args,
+            kwargs.get('threaded', False))
 
     def fire_event(self, event, *args):
-        logging.debug('event: %s' % event)
-        if event in self.listeners:
-            for l in self.listeners[event]:
-                try:
-                    cargs = []
-                    cargs.extend(args)
-                    cargs.extend(l[1])
-                    l[0](*cargs)
-                except Exception as e:
-                    logging.error('Caught error in event listener: %s' % e)
-                    traceback.print_exc()
-        else:
-            raise ValueError('Unknown event "%s"' % event)
+        self.events.fire(event, *args)
 
     def event_callback(self, result, event, *args):
         self.fire_event(event, *args)
@@ -0,0 +1,163 @@
+from downpour.core.fairness import fair_share, fair_slots
+from twisted.internet import task
+
+# Shares the global rate and connection limits between active downloads
+# with weighted max-min fairness, based on what each client actually
+# used since the last pass. Headroom a stalled download can't use is
+# handed to the others, and reclaimed once it picks up again.
+# User.max_rate caps the download rate of all of a user's downloads,
+# Download.max_rate and max_upload_rate cap a single download.
+class BandwidthAllocator(object):
+
+    # Fraction of its allocation a client must use to be given more
+    saturation = 0.9
+    # Headroom given on top of measured usage for unsaturated clients
+    growth = 1.25
+    # Lowest rate (bytes/s) and connection count any client is limited to
+    minimum_rate = 2048
+    minimum_connections = 4
+
+    def __init__(self, manager, interval=5):
+        self.manager = manager
+        self.interval = interval
+        self.loop = None
+        self.allocations = {}
+
+    def start(self):
+        self.loop = task.LoopingCall(self.allocate)
+        self.loop.start(self.interval, False)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def get_allocation(self, id):
+        return self.allocations.get(id, None)
+
+    def get_report(self):
+        return self.allocations
+
+    def allocate(self):
+        manager = self.manager
+        max_ulrate = manager.get_int_setting('upload_rate') * 1024
+        max_dlrate = manager.get_int_setting('download_rate') * 1024
+        max_conn = manager.get_int_setting('connection_limit')
+
+        clients = {}
+        downloads = {}
+        for d in manager.get_index().all():
+            if d.active:
+                dc = manager.get_download_client(d.id)
+                if dc:
+                    clients[d.id] = dc
+                    downloads[d.id] = d
+
+        weights = dict([(id, self.weight(downloads[id])) for id in downloads])
+
+        dlrates = self.allocate_rates(max_dlrate, downloads, clients, weights,
+            'downloadrate', 'download_rate', 'max_rate', True)
+        ulrates = self.allocate_rates(max_ulrate, downloads, clients, weights,
+            'uploadrate', 'upload_rate', 'max_upload_rate', False)
+        conns = None
+        if max_conn > 0:
+            demands = dict([(id, int(self.demand(downloads[id].connections,
+                clients[id].max_connections, max_conn, self.minimum_connections)))
+                for id in downloads])
+            conns = fair_slots(max_conn, demands, weights)
+
+        allocations = {}
+        for id in clients:
+            dc = clients[id]
+            d = downloads[id]
+            dlrate = int(dlrates.get(id, 0))
+            ulrate = int(ulrates.get(id, 0))
+            conn = 0
+            if conns is not None:
+                # Clients treat 0 as unlimited, so downloads left without
+                # a share still get a single connection
+                conn = max(conns.get(id, 0), 1)
+            if dc.download_rate != dlrate:
+                dc.set_download_rate(dlrate)
+            if dc.upload_rate != ulrate:
+                dc.set_upload_rate(ulrate)
+            if dc.max_connections != conn:
+                dc.set_max_connections(conn)
+            allocations[id] = {
+                'downloadrate': dlrate,
+                'downloadrate_used': int(d.downloadrate),
+                'uploadrate': ulrate,
+                'uploadrate_used': int(d.uploadrate),
+                'connections': conn,
+                'connections_used': d.connections
+            }
+        self.allocations = allocations
+
+    # Returns {id: rate}, 0 meaning unlimited
+    def allocate_rates(self, capacity, downloads, clients, weights,
+            used_attr, alloc_attr, cap_attr, per_user):
+        users = {}
+        for id in downloads:
+            user = downloads[id].user
+            limit = 0
+            if per_user and user and user.max_rate:
+                limit = user.max_rate * 1024
+            if not downloads[id].user_id in users:
+                users[downloads[id].user_id] = (limit, [])
+            users[downloads[id].user_id][1].append(id)
+
+        caps = dict([(id, (getattr(downloads[id], cap_attr) or 0) * 1024)
+            for id in downloads])
+
+        if not capacity and not [u for u in users if users[u][0]] and \
+                not [id for id in caps if caps[id]]:
+            return {}
+
+        demands = {}
+        for id in downloads:
+            limit = users[downloads[id].user_id][0]
+            demands[id] = self.demand(getattr(downloads[id], used_attr),
+                getattr(clients[id], alloc_attr), capacity or limit or caps[id],
+                self.minimum_rate)
+            if caps[id]:
+                demands[id] = min(demands[id], caps[id])
+
+        # Share the capacity between users first, so per-user caps and
+        # user weights apply, then between each user's downloads
+        user_demands = {}
+        for u in users:
+            total = sum([demands[id] for id in users[u][1]])
+            if users[u][0]:
+                total = min(total, users[u][0])
+            user_demands[u] = total
+        if capacity:
+            user_alloc = fair_share(capacity, user_demands)
+        else:
+            user_alloc = dict([(u, users[u][0]) for u in users])
+        for u in users:
+            if users[u][0]:
+                user_alloc[u] = min(user_alloc[u], users[u][0])
+
+        rates = {}
+        for u in users:
+            if not user_alloc[u]:
+                continue
+            rates.update(fair_share(user_alloc[u], dict([(id, demands[id])
+                for id in users[u][1]]), weights))
+
+        # Capped downloads are never unlimited, even without a global limit
+        for id in caps:
+            if caps[id] and (not rates.get(id) or rates[id] > caps[id]):
+                rates[id] = caps[id]
+        return rates
+
+    # Demand estimate for a client that used `used` out of `allocated`
+    def demand(self, used, allocated, capacity, minimum):
+        if not allocated or used >= allocated * self.saturation:
+            return capacity
+        return min(max(used * self.growth, minimum), capacity)
+
+    # Higher priority downloads get a larger share
+    def weight(self, d):
+        if d.priority and d.priority > 0:
+            return 1 + d.priority
+        return 1
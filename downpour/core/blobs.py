@@ -0,0 +1,65 @@
+import hashlib, zlib
+
+# Helpers for the out-of-row blob store (models.Blob). Blobs are zlib
+# compressed and stored under a key: torrent metadata under its info hash
+# so identical torrents share one copy, resume data under its download
+# id so new resume data replaces the old in place.
+
+def compress(data):
+    return zlib.compress(data, 6)
+
+def decompress(data):
+    return zlib.decompress(data)
+
+def content_key(obj, data):
+    return u'sha1:%s' % hashlib.sha1(data).hexdigest()
+
+def torrent_key(obj, data):
+    info = bencoded_value(data, 'info')
+    if info is None:
+        return content_key(obj, data)
+    return u'torrent:%s' % hashlib.sha1(info).hexdigest()
+
+def download_key(obj, data):
+    if obj.id is None:
+        return content_key(obj, data)
+    return u'resume:%d' % obj.id
+
+# Returns the raw bencoded value stored under key in a top-level bencoded
+# dictionary (the info hash is the SHA-1 of the raw "info" value), or
+# None if data isn't such a dictionary
+def bencoded_value(data, key):
+    try:
+        if data[0] != 'd':
+            return None
+        pos = 1
+        while data[pos] != 'e':
+            kstart, pos = skip(data, pos)
+            name = data[kstart:pos]
+            name = name[name.index(':') + 1:]
+            vstart, pos = skip(data, pos)
+            if name == key:
+                return data[vstart:pos]
+    except (IndexError, ValueError):
+        pass
+    return None
+
+# Skips one bencoded value, returns (start, end)
+def skip(data, pos):
+    start = pos
+    c = data[pos]
+    if c == 'i':
+        pos = data.index('e', pos) + 1
+    elif c == 'l' or c == 'd':
+        pos += 1
+        while data[pos] != 'e':
+            pos = skip(data, pos)[1]
+        pos += 1
+    elif c.isdigit():
+        colon = data.index(':', pos)
+        pos = colon + 1 + int(data[pos:colon])
+        if pos > len(data):
+            raise ValueError('Truncated string')
+    else:
+        raise ValueError('Invalid bencoding')
+    return (start, pos)
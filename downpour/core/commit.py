@@ -0,0 +1,53 @@
+from twisted.internet import reactor
+import logging
+
+# Coalesces store commits. Callers mark the store dirty with commit(),
+# and a single real commit is issued after the configured interval
+# (or at the end of the current reactor turn if the interval is 0).
+# Use flush() for changes that must be durable right away. A failed
+# commit (e.g. SQLITE_BUSY while another connection holds the write
+# lock) keeps the changes and is retried after retry_delay seconds.
+class CommitScheduler(object):
+
+    retry_delay = 1.0
+
+    def __init__(self, store, interval=0):
+        self.store = store
+        self.interval = interval
+        self.dirty = False
+        self.pending = None
+        self.requested = 0
+        self.committed = 0
+        self.failed = 0
+
+    def commit(self):
+        self.requested += 1
+        self.dirty = True
+        if self.pending is None:
+            self.pending = reactor.callLater(self.interval, self.flush)
+
+    def flush(self):
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        if self.dirty:
+            try:
+                self.store.commit()
+            except Exception as e:
+                # Rolling back would discard every change coalesced since
+                # the last commit, leave them pending instead
+                self.failed += 1
+                logging.error('Store commit failed, retrying: %s' % e)
+                self.pending = reactor.callLater(
+                    max(self.interval, self.retry_delay), self.flush)
+                return
+            self.dirty = False
+            self.committed += 1
+
+    def get_stats(self):
+        return {'requested': self.requested,
+                'committed': self.committed,
+                'avoided': self.requested - self.committed,
+                'failed': self.failed,
+                'pending': self.dirty}
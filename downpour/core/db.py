@@ -1,4 +1,4 @@
-from downpour.core import models, sqlitefk, VERSION
+from downpour.core import models, sqlitefk, blobs, VERSION
 from storm.locals import *
 import logging
 #import sys
@@ -91,12 +91,16 @@ def initialize_db(store):
         "media_type TEXT," +
         "mime_type TEXT," +
         "description TEXT," +
-        "metadata BLOB," +
+        "metadata_key TEXT," +
         "info_hash BLOB," +
-        "resume_data BLOB," +
+        "resume_key TEXT," +
         "active BOOLEAN," +
         "status INTEGER," +
         "status_message TEXT," +
+        "priority INTEGER DEFAULT 0," +
+        "max_rate INTEGER," +
+        "max_upload_rate INTEGER," +
+        "seed_ratio REAL," +
         "progress REAL," +
         "size REAL," +
         "downloaded REAL," +
@@ -113,6 +117,34 @@ def initialize_db(store):
     store.execute("CREATE INDEX downloads_completed on downloads(completed)")
     store.execute("CREATE INDEX downloads_deleted on downloads(deleted)")
 
+    # Deleted downloads past their retention period, see core.maintenance
+    store.execute("CREATE TABLE downloads_archive (" +
+        "id INTEGER PRIMARY KEY," +
+        "user_id INTEGER," +
+        "feed_id INTEGER," +
+        "url TEXT," +
+        "filename TEXT," +
+        "media_type TEXT," +
+        "mime_type TEXT," +
+        "description TEXT," +
+        "info_hash BLOB," +
+        "status INTEGER," +
+        "size REAL," +
+        "downloaded REAL," +
+        "uploaded REAL," +
+        "added INTEGER," +
+        "started INTEGER," +
+        "completed INTEGER," +
+        "archived INTEGER" +
+        ")")
+
+    # Compressed torrent metadata and resume data, see core.blobs
+    store.execute("CREATE TABLE blobs (" +
+        "id TEXT PRIMARY KEY," +
+        "data BLOB," +
+        "size INTEGER" +
+        ")")
+
     store.execute("CREATE TABLE feed_items (" +
         "id INTEGER PRIMARY KEY," +
         "feed_id INTEGER," +
@@ -162,6 +194,68 @@ def upgrade_database(application):
         return schema_upgraders[VERSION](application, version)
     return False
 
+def upgrade_to_0_2_2(application, version):
+    upgraded = True
+    if version != '0.2.1':
+        upgraded = upgrade_to_0_2_1(application, version)
+    if upgraded:
+        logging.info('Upgrading database from v0.2.1 to v0.2.2')
+        store = application.get_store()
+        store.execute("ALTER TABLE downloads ADD COLUMN priority INTEGER DEFAULT 0")
+        store.execute("ALTER TABLE downloads ADD COLUMN max_rate INTEGER")
+        store.execute("ALTER TABLE downloads ADD COLUMN max_upload_rate INTEGER")
+        store.execute("ALTER TABLE downloads ADD COLUMN seed_ratio REAL")
+        store.execute("CREATE TABLE downloads_archive (" +
+            "id INTEGER PRIMARY KEY," +
+            "user_id INTEGER," +
+            "feed_id INTEGER," +
+            "url TEXT," +
+            "filename TEXT," +
+            "media_type TEXT," +
+            "mime_type TEXT," +
+            "description TEXT," +
+            "info_hash BLOB," +
+            "status INTEGER," +
+            "size REAL," +
+            "downloaded REAL," +
+            "uploaded REAL," +
+            "added INTEGER," +
+            "started INTEGER," +
+            "completed INTEGER," +
+            "archived INTEGER" +
+            ")")
+        store.execute("CREATE TABLE blobs (" +
+            "id TEXT PRIMARY KEY," +
+            "data BLOB," +
+            "size INTEGER" +
+            ")")
+        store.execute("ALTER TABLE downloads ADD COLUMN metadata_key TEXT")
+        store.execute("ALTER TABLE downloads ADD COLUMN resume_key TEXT")
+        move_download_blobs(store)
+        store.execute("UPDATE STATE SET value = '0.2.2' WHERE name = 'schema_version'")
+    return upgraded
+
+# Moves inline metadata and resume data into the blobs table. SQLite
+# can't drop columns, the old ones are left empty.
+def move_download_blobs(store):
+    rows = store.execute("SELECT id, metadata, resume_data FROM downloads " +
+        "WHERE metadata IS NOT NULL OR resume_data IS NOT NULL").get_all()
+    for (id, metadata, resume_data) in rows:
+        metadata_key = resume_key = None
+        if metadata is not None:
+            metadata = str(metadata)
+            metadata_key = blobs.torrent_key(None, metadata)
+            store.execute("INSERT OR IGNORE INTO blobs(id, data, size) VALUES (?, ?, ?)",
+                (metadata_key, buffer(blobs.compress(metadata)), len(metadata)))
+        if resume_data is not None:
+            resume_data = str(resume_data)
+            resume_key = u'resume:%d' % id
+            store.execute("INSERT OR REPLACE INTO blobs(id, data, size) VALUES (?, ?, ?)",
+                (resume_key, buffer(blobs.compress(resume_data)), len(resume_data)))
+        store.execute("UPDATE downloads SET metadata_key = ?, resume_key = ?, " +
+            "metadata = NULL, resume_data = NULL WHERE id = ?",
+            (metadata_key, resume_key, id))
+
 def upgrade_to_0_2_1(application, version):
     upgraded = True
     if version != '0.2':
@@ -218,6 +312,7 @@ def upgrade_to_0_1_1pre(application, version):
 
 # Add new upgraders to this dict
 schema_upgraders = {
+    '0.2.2': upgrade_to_0_2_2,
     '0.2.1': upgrade_to_0_2_1,
     '0.2': upgrade_to_0_2,
     '0.1.1': upgrade_to_0_1_1,
@@ -0,0 +1,81 @@
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from storm.locals import Store
+import threading
+
+# Runs database work on its own threads, each with a private Storm store
+# and connection, so the reactor thread never waits on the disk.
+#
+# Work functions are called as func(store, *args) and must return plain
+# values (tuples, dicts) rather than Storm objects, since objects from
+# these stores can't be used from the reactor thread.
+class DatabaseThreadPool(object):
+
+    def __init__(self, database, size, name, readonly=False):
+        self.database = database
+        self.readonly = readonly
+        self.pool = ThreadPool(1, size, name)
+        self.local = threading.local()
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+    def run(self, func, *args, **kwargs):
+        return threads.deferToThreadPool(reactor, self.pool,
+            self.call, func, args, kwargs)
+
+    # Runs in a pool thread
+    def call(self, func, args, kwargs):
+        store = getattr(self.local, 'store', None)
+        if store is None:
+            store = self.local.store = Store(self.database)
+        try:
+            result = func(store, *args, **kwargs)
+            if self.readonly:
+                # End the read transaction so the next call sees a
+                # fresh snapshot
+                store.rollback()
+            else:
+                store.commit()
+            return result
+        except:
+            store.rollback()
+            raise
+
+# Asynchronous data access: writes are serialized on a single writer
+# thread, reads run on a small pool of reader threads. Each call runs in
+# one transaction, so reads see a consistent snapshot of the database.
+class DataAccess(object):
+
+    def __init__(self, database, readers=2):
+        self.writer = DatabaseThreadPool(database, 1, 'downpour-db-writer')
+        self.reader = DatabaseThreadPool(database, readers,
+            'downpour-db-reader', True)
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.writer.start()
+            self.reader.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.writer.stop()
+            self.reader.stop()
+
+    # Returns a Deferred firing with func(store, *args) after it has been
+    # committed
+    def write(self, func, *args, **kwargs):
+        self.start()
+        return self.writer.run(func, *args, **kwargs)
+
+    # Returns a Deferred firing with func(store, *args), run read-only
+    def snapshot(self, func, *args, **kwargs):
+        self.start()
+        return self.reader.run(func, *args, **kwargs)
@@ -0,0 +1,137 @@
+from twisted.internet import reactor, threads
+import logging, traceback, time
+
+# Application event bus. In 'sync' mode listeners run inside fire_event()
+# as they always have; in 'queued' mode events are queued and dispatched
+# on a later reactor turn, so a slow listener can't stall the code that
+# fired the event. Listeners registered with threaded=True are run in the
+# reactor thread pool and must not touch the Storm store.
+class EventBus(object):
+
+    # Latency histogram bucket upper bounds, in milliseconds
+    buckets = (1, 5, 10, 50, 100, 500, 1000, 5000, None)
+
+    def __init__(self, events, mode='sync', slow_threshold=100):
+        self.listeners = dict([(e, []) for e in events])
+        self.mode = mode
+        self.slow_threshold = slow_threshold
+        self.queue = []
+        self.pending = None
+        self.stats = {}
+        self.slow = []
+
+    def add_listener(self, event, listener, args=(), threaded=False):
+        if event in self.listeners:
+            self.listeners[event].append([listener, args, threaded])
+
+    def fire(self, event, *args):
+        if not event in self.listeners:
+            raise ValueError('Unknown event "%s"' % event)
+        logging.debug('event: %s' % event)
+        if self.mode == 'queued':
+            self.queue.append((event, args))
+            if self.pending is None:
+                self.pending = reactor.callLater(0, self.dispatch_queued)
+        else:
+            self.dispatch(event, args)
+
+    # Dispatch everything queued so far, including events fired while
+    # dispatching
+    def flush(self):
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        while self.queue:
+            event, args = self.queue.pop(0)
+            self.dispatch(event, args)
+
+    def dispatch_queued(self):
+        self.pending = None
+        # Events fired by listeners wait for the next turn
+        queue = self.queue
+        self.queue = []
+        for event, args in queue:
+            self.dispatch(event, args)
+
+    def dispatch(self, event, args):
+        for l in list(self.listeners[event]):
+            cargs = []
+            cargs.extend(args)
+            cargs.extend(l[1])
+            if l[2]:
+                started = time.time()
+                dfr = threads.deferToThread(l[0], *cargs)
+                dfr.addCallback(self.threaded_done, event, l[0], started)
+                dfr.addErrback(self.threaded_failed, event, l[0], started)
+            else:
+                self.call(event, l[0], cargs)
+
+    def call(self, event, listener, cargs):
+        started = time.time()
+        failed = False
+        try:
+            listener(*cargs)
+        except Exception as e:
+            failed = True
+            logging.error('Caught error in event listener: %s' % e)
+            traceback.print_exc()
+        self.record(event, listener, started, failed)
+
+    def threaded_done(self, result, event, listener, started):
+        self.record(event, listener, started, False)
+
+    def threaded_failed(self, failure, event, listener, started):
+        logging.error('Caught error in event listener: %s' % failure.getErrorMessage())
+        self.record(event, listener, started, True)
+
+    def record(self, event, listener, started, failed):
+        elapsed = (time.time() - started) * 1000
+        name = self.listener_name(listener)
+        key = (event, name)
+        if not key in self.stats:
+            self.stats[key] = {
+                'event': event,
+                'listener': name,
+                'calls': 0,
+                'errors': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'histogram': [0] * len(self.buckets)
+            }
+        s = self.stats[key]
+        s['calls'] += 1
+        s['total'] += elapsed
+        s['max'] = max(s['max'], elapsed)
+        if failed:
+            s['errors'] += 1
+        for i in range(0, len(self.buckets)):
+            if self.buckets[i] is None or elapsed <= self.buckets[i]:
+                s['histogram'][i] += 1
+                break
+        if self.slow_threshold and elapsed > self.slow_threshold:
+            logging.warning('Slow event listener %s for %s: %dms' % (name, event, elapsed))
+            self.slow.append({'event': event, 'listener': name,
+                'elapsed': elapsed, 'time': int(started)})
+            # Only keep the most recent warnings
+            del self.slow[:-50]
+
+    def listener_name(self, listener):
+        if hasattr(listener, 'im_class'):
+            return '%s.%s.%s' % (listener.im_class.__module__,
+                listener.im_class.__name__, listener.__name__)
+        if hasattr(listener, '__module__') and hasattr(listener, '__name__'):
+            return '%s.%s' % (listener.__module__, listener.__name__)
+        return repr(listener)
+
+    def get_stats(self):
+        listeners = []
+        for key in sorted(self.stats):
+            s = dict(self.stats[key])
+            s['average'] = s['total'] / s['calls']
+            listeners.append(s)
+        return {'mode': self.mode,
+                'queued': len(self.queue),
+                'buckets': [b for b in self.buckets],
+                'listeners': listeners,
+                'slow': list(self.slow)}
@@ -0,0 +1,59 @@
+import heapq
+
+# Weighted max-min fair division of a capacity among consumers. Capacity
+# one consumer can't use is shared out among the rest in proportion to
+# their weights. A capacity of None means unlimited.
+#
+# fair_slots() divides whole units (download slots, connections) and
+# never gives a consumer more than it demands. Units consumers already
+# hold elsewhere can be passed as base, and count towards their share
+# without being part of the capacity.
+#
+# fair_share() divides a rate, and hands out capacity left over once
+# every demand is met as headroom, so consumers can receive more than
+# they demand.
+
+def fair_slots(capacity, demands, weights=None, base=None):
+    if capacity is None or capacity >= sum([max(demands[k], 0) for k in demands]):
+        return dict([(k, max(demands[k], 0)) for k in demands])
+    weight = lambda k: (weights and weights.get(k)) or 1
+    held = lambda k: (base and base.get(k)) or 0
+    alloc = dict([(k, 0) for k in demands])
+    # Next slot goes to the consumer furthest below its weighted share
+    heap = [(float(held(k) + 1) / weight(k), k) for k in demands if demands[k] > 0]
+    heapq.heapify(heap)
+    while capacity > 0 and heap:
+        k = heapq.heappop(heap)[1]
+        alloc[k] += 1
+        capacity -= 1
+        if alloc[k] < demands[k]:
+            heapq.heappush(heap, (float(held(k) + alloc[k] + 1) / weight(k), k))
+    return alloc
+
+def fair_share(capacity, demands, weights=None):
+    if capacity is None:
+        return dict(demands)
+    weight = lambda k: (weights and weights.get(k)) or 1
+    alloc = dict([(k, 0.0) for k in demands])
+    wanting = set([k for k in demands if demands[k] > 0])
+    capacity = float(capacity)
+    # Water-filling: satisfy everyone asking for less than an equal
+    # weighted share, then split what is left among the rest
+    while wanting and capacity > 0:
+        share = capacity / sum([weight(k) for k in wanting])
+        satisfied = [k for k in wanting if demands[k] - alloc[k] <= share * weight(k)]
+        if not satisfied:
+            for k in wanting:
+                alloc[k] += share * weight(k)
+            capacity = 0
+            break
+        for k in satisfied:
+            capacity -= demands[k] - alloc[k]
+            alloc[k] = float(demands[k])
+            wanting.remove(k)
+    # Unused capacity is handed out as headroom so consumers can grow
+    if capacity > 0 and alloc:
+        share = capacity / sum([weight(k) for k in alloc])
+        for k in alloc:
+            alloc[k] += share * weight(k)
+    return alloc
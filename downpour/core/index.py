@@ -0,0 +1,135 @@
+from downpour.core.runtime import TransferState, get_state
+from storm.info import get_obj_info
+
+# In-memory index of live (non-deleted) downloads, owned by GlobalManager.
+# Status, user and feed buckets are kept current by hooking Storm's
+# variable change events, so status changes made directly by download
+# clients are picked up without any extra bookkeeping.
+#
+# Listeners registered with add_listener() are notified of every change
+# through added(d), removed(d) and changed(d, name, old_value, new_value).
+class DownloadIndex(object):
+
+    def __init__(self, downloads=()):
+        self.by_id = {}
+        self.by_status = {}
+        self.by_user = {}
+        self.by_feed = {}
+        self.order = {}
+        self.sequence = 0
+        self.listeners = []
+        for d in downloads:
+            self.add(d)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        for d in self.all():
+            listener.added(d)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def add(self, d):
+        if d.id in self.by_id:
+            return
+        self.by_id[d.id] = d
+        self.order[d.id] = self.sequence
+        self.sequence += 1
+        self.bucket(self.by_status, d.status).add(d.id)
+        self.bucket(self.by_user, d.user_id).add(d.id)
+        self.bucket(self.by_feed, d.feed_id).add(d.id)
+        event = get_obj_info(d).event
+        event.hook('changed', self.changed, d)
+        event.hook('transient-changed', self.transient_changed, d)
+        for l in self.listeners:
+            l.added(d)
+
+    def remove(self, d):
+        if not d.id in self.by_id:
+            return
+        del self.by_id[d.id]
+        del self.order[d.id]
+        self.unbucket(self.by_status, d.status, d.id)
+        self.unbucket(self.by_user, d.user_id, d.id)
+        self.unbucket(self.by_feed, d.feed_id, d.id)
+        event = get_obj_info(d).event
+        event.unhook('changed', self.changed, d)
+        event.unhook('transient-changed', self.transient_changed, d)
+        # Listeners are torn down in reverse order of registration
+        for l in reversed(self.listeners):
+            l.removed(d)
+
+    def get(self, id):
+        return self.by_id.get(id, None)
+
+    def all(self):
+        return self.sorted(self.by_id)
+
+    def with_status(self, *statuses):
+        ids = []
+        for s in statuses:
+            ids.extend(self.by_status.get(s, ()))
+        return self.sorted(ids)
+
+    def for_user(self, user_id):
+        return self.sorted(self.by_user.get(user_id, ()))
+
+    def for_feed(self, feed_id):
+        return self.sorted(self.by_feed.get(feed_id, ()))
+
+    def count(self, status=None):
+        if status is None:
+            return len(self.by_id)
+        return len(self.by_status.get(status, ()))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    # Always returns a new list in the order downloads were added
+    def sorted(self, ids):
+        ids = list(ids)
+        ids.sort(key=self.order.__getitem__)
+        return [self.by_id[id] for id in ids]
+
+    def bucket(self, buckets, key):
+        if not key in buckets:
+            buckets[key] = set()
+        return buckets[key]
+
+    def unbucket(self, buckets, key, id):
+        if key in buckets:
+            buckets[key].discard(id)
+            if not buckets[key]:
+                del buckets[key]
+
+    # Storm event hook, called whenever a column variable changes
+    def changed(self, obj_info, variable, old_value, new_value, fromdb, d):
+        if not d.id in self.by_id:
+            return
+        column = variable.column.name
+        buckets = None
+        if column == 'status':
+            buckets = self.by_status
+        elif column == 'user_id':
+            buckets = self.by_user
+        elif column == 'feed_id':
+            buckets = self.by_feed
+        elif column == 'deleted':
+            if new_value:
+                self.remove(d)
+            return
+        if buckets is not None:
+            self.unbucket(buckets, old_value, d.id)
+            self.bucket(buckets, new_value).add(d.id)
+        # Columns backed by a TransferState only change on checkpoints,
+        # readers already saw the live value
+        if column in TransferState.persistent and get_state(d) is not None:
+            return
+        for l in self.listeners:
+            l.changed(d, column, old_value, new_value)
+
+    # Called when a non-persistent models.Transient attribute changes
+    def transient_changed(self, obj_info, name, old_value, new_value, d):
+        for l in self.listeners:
+            l.changed(d, name, old_value, new_value)
@@ -0,0 +1,171 @@
+from downpour.core import models
+from downpour.core.sqlitefk import sqlite
+from twisted.internet import task
+from storm.expr import Exists, Not, Select, Or
+from time import time
+import os, logging
+
+# Periodic database maintenance. Deleted downloads lose their torrent
+# metadata and resume data right away (blobs no download refers to any
+# more are then purged), and are moved to the
+# downloads_archive table once they are older than the retention period
+# (unless library files still refer to them). Removed feed items are kept
+# for duplicate detection but their content is dropped. Freed pages are
+# then returned to the filesystem with an incremental vacuum (see
+# enable_incremental_vacuum()).
+class MaintenanceJob(object):
+
+    # Rows handled per run, and pages vacuumed per run, to bound the
+    # time the database is locked for writing
+    batch = 500
+    vacuum_pages = 2000
+
+    archive_columns = ('id', 'user_id', 'feed_id', 'url', 'filename',
+        'media_type', 'mime_type', 'description', 'info_hash', 'status',
+        'size', 'downloaded', 'uploaded', 'added', 'started', 'completed')
+
+    def __init__(self, manager, db_path, interval=86400, retention=30):
+        self.manager = manager
+        self.db_path = db_path
+        self.interval = interval
+        self.retention = retention
+        self.loop = None
+        self.report = None
+
+    def start(self):
+        self.loop = task.LoopingCall(self.run)
+        self.loop.start(self.interval, False)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def get_report(self):
+        return self.report
+
+    def run(self):
+        # Pending changes of the main store go out first
+        self.manager.flush()
+        dfr = self.manager.application.get_data_access().write(self.maintain, time())
+        dfr.addCallback(self.maintained)
+        dfr.addErrback(self.failed)
+        return dfr
+
+    # Runs on the database writer thread with its own store
+    def maintain(self, store, started):
+        before = self.database_size()
+
+        report = {'stripped_downloads': self.strip_downloads(store)}
+        report['purged_blobs'] = self.purge_blobs(store)
+        if self.retention:
+            cutoff = int(started - self.retention * 86400)
+            report['archived_downloads'] = self.archive_downloads(store, cutoff)
+            report['stripped_feed_items'] = self.strip_feed_items(store, cutoff)
+        else:
+            report['archived_downloads'] = 0
+            report['stripped_feed_items'] = 0
+        store.commit()
+
+        try:
+            self.compact()
+        except Exception as e:
+            logging.error('Database compaction failed: %s' % e)
+
+        report['reclaimed'] = max(before - self.database_size(), 0)
+        report['time'] = int(started)
+        report['elapsed'] = time() - started
+        return report
+
+    def maintained(self, report):
+        self.report = report
+        logging.info('Database maintenance: stripped %(stripped_downloads)d '
+            'downloads, archived %(archived_downloads)d, stripped '
+            '%(stripped_feed_items)d feed items, purged %(purged_blobs)d blobs, '
+            'reclaimed %(reclaimed)d bytes'
+            % report)
+
+    def failed(self, failure):
+        logging.error('Database maintenance failed: %s' % failure.getErrorMessage())
+
+    def strip_downloads(self, store):
+        downloads = store.find(models.Download,
+            models.Download.deleted == True,
+            Or(models.Download.metadata_key != None,
+                models.Download.resume_key != None))[:self.batch]
+        count = 0
+        for d in downloads:
+            d.metadata = None
+            d.resume_data = None
+            count += 1
+        return count
+
+    # Torrent metadata blobs are shared between downloads of the same
+    # torrent, so they are only removed once nothing refers to them
+    def purge_blobs(self, store):
+        store.flush()
+        result = store.execute('DELETE FROM blobs WHERE id NOT IN '
+            '(SELECT metadata_key FROM downloads WHERE metadata_key IS NOT NULL '
+            'UNION SELECT resume_key FROM downloads WHERE resume_key IS NOT NULL)')
+        return max(result.rowcount, 0)
+
+    def archive_downloads(self, store, cutoff):
+        downloads = list(store.find(models.Download,
+            models.Download.deleted == True,
+            Or(models.Download.completed < cutoff,
+                models.Download.completed == None),
+            models.Download.added < cutoff,
+            Not(Exists(Select(models.File.id,
+                models.File.download_id == models.Download.id)))
+            )[:self.batch])
+        if not downloads:
+            return 0
+        columns = ', '.join(self.archive_columns)
+        ids = ', '.join([str(d.id) for d in downloads])
+        store.execute('INSERT OR REPLACE INTO downloads_archive (%s, archived) '
+            'SELECT %s, %d FROM downloads WHERE id IN (%s)'
+            % (columns, columns, int(time()), ids))
+        for d in downloads:
+            store.remove(d)
+        return len(downloads)
+
+    def strip_feed_items(self, store, cutoff):
+        items = store.find(models.FeedItem,
+            models.FeedItem.removed == True,
+            models.FeedItem.updated < cutoff,
+            models.FeedItem.content != None)[:self.batch]
+        count = 0
+        for i in items:
+            i.content = None
+            count += 1
+        return count
+
+    # Runs on its own connection, outside of the store's transaction
+    def compact(self):
+        conn = sqlite.connect(self.db_path, isolation_level=None)
+        try:
+            # A no-op unless auto_vacuum is incremental. executescript()
+            # steps the pragma to completion, execute() would only free a
+            # single page.
+            conn.executescript('PRAGMA incremental_vacuum(%d);' % self.vacuum_pages)
+            conn.execute('ANALYZE')
+        finally:
+            conn.close()
+
+    def database_size(self):
+        try:
+            return os.path.getsize(self.db_path)
+        except OSError:
+            return 0
+
+# One-off conversion to incremental auto_vacuum, which needs a full
+# VACUUM. Called at startup before the database is opened for anything
+# else, since a VACUUM of a large database holds the write lock for long.
+def enable_incremental_vacuum(db_path):
+    conn = sqlite.connect(db_path, isolation_level=None)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            logging.info('Enabling incremental vacuum on %s' % db_path)
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
@@ -1,107 +1,84 @@
-from downpour.core import VERSION, models, organizer
-from downpour.core.net import get_interface
-from downpour.download import Status
+from downpour.core import VERSION, models, organizer, scheduling, startup, timers
+from downpour.core.index import DownloadIndex
+from downpour.core.status import StatusAggregator, HostSampler
+from downpour.core.bandwidth import BandwidthAllocator
+from downpour.core.runtime import RuntimeTable
+from downpour.core.maintenance import MaintenanceJob
+from downpour.core.resume import ResumePipeline
+from downpour.download import Status, DownloadState
 from downpour.download.throttling import ThrottledBucketFilter
-from downpour.download.http import HTTPDownloadClient
-from downpour.download.torrent import LibtorrentClient
+from downpour.download import registry
 from twisted.web import http
-from twisted.internet import threads, defer
+from twisted.internet import threads, defer, reactor
 from time import time
 from urlparse import urlparse
-import feedparser, os, mimetypes, logging, tempfile, shutil
-import urllib, socket
+import os, mimetypes, logging, tempfile, shutil
+import urllib
 
 class Manager:
 
-    download_clients = []
-    downloads = None
+    # Download clients by download id, shared by all managers
+    download_clients = {}
     feeds = None
     libraries = None
 
-    client_mimetypes = {
-        'application/x-bittorrent': LibtorrentClient
-        }
-    client_protocols = {
-        'http': HTTPDownloadClient,
-        'https': HTTPDownloadClient,
-        'magnet': LibtorrentClient
-        }
-
     def __init__(self, application):
         self.application = application
         self.store = application.get_store()
+        self.committer = application.get_commit_scheduler()
         self.paused = self.application.is_paused()
 
     def get_status(self):
 
-        s = os.statvfs(self.get_work_directory())
-        diskfree = s.f_bfree * s.f_bsize
-        diskfreepct = (float(s.f_bfree) / s.f_blocks) * 100
-
-        s = os.statvfs(self.get_user_directory())
-        userdiskfree = s.f_bfree * s.f_bsize
-        userdiskfreepct = (float(s.f_bfree) / s.f_blocks) * 100
+        totals = self.get_totals()
+        host = self.application.manager.sampler.get_sample()
 
-        queuedsize = 0
-        queueddone = 0
-        active_downloads = 0
-        queued_downloads = 0
-        download_rate = 0
-        upload_rate = 0
-        connections = 0
-
-        downloads = self.get_downloads()
-        for d in downloads:
-            if d.size:
-                queuedsize += d.size
-                queueddone += d.downloaded
-            if d.active:
-                active_downloads += 1
-            if d.status == Status.QUEUED:
-                queued_downloads += 1
-            download_rate += d.downloadrate
-            upload_rate += d.uploadrate
-            connections += d.connections
-
-        if queuedsize:
-            progress = round((float(queueddone) / queuedsize) * 100, 2)
+        if totals['queuedsize']:
+            progress = round((float(totals['queueddone']) / totals['queuedsize']) * 100, 2)
         else:
             progress = 0
 
-        interface = None
-        try:
-            interface = get_interface(self.get_option(
-                ('downpour', 'interface'), '0.0.0.0'))
-            if interface == '0.0.0.0':
-                # Load IPs for local host
-                ips = [i[4][0] for i in socket.getaddrinfo(socket.gethostname(), None)]
-                ips = filter(lambda ip: ip[:4] != '127.' and ip[:2] != '::', ips)
-                interface = ', '.join(dict(map(lambda i: (i,1), ips)).keys())
-        except IOError as ioe:
-            interface = 'disconnected'
-
-        hostname = '%s (%s)' % (socket.gethostname(), interface)
-
-        status = {'host': hostname,
+        status = {'host': host['host'],
                 'version': VERSION,
-                'downloads': len(downloads),
-                'active_downloads': active_downloads,
-                'queued_downloads': queued_downloads,
-                'downloadrate': download_rate,
-                'uploadrate': upload_rate,
+                'downloads': totals['downloads'],
+                'active_downloads': totals['active_downloads'],
+                'queued_downloads': totals['queued_downloads'],
+                'downloadrate': totals['downloadrate'],
+                'uploadrate': totals['uploadrate'],
                 'progress': progress,
-                'diskfree': diskfree,
-                'diskfreepct': diskfreepct,
-                'userdiskfree': userdiskfree,
-                'userdiskfreepct': userdiskfreepct,
-                'connections': connections,
-                'paused': self.paused
+                'diskfree': host['diskfree'],
+                'diskfreepct': host['diskfreepct'],
+                'userdiskfree': host['userdiskfree'],
+                'userdiskfreepct': host['userdiskfreepct'],
+                'connections': totals['connections'],
+                'paused': self.paused,
+                'commits': self.committer.get_stats(),
+                'checkpoints': self.application.manager.runtime.get_stats(),
+                'maintenance': self.application.manager.maintenance.get_report(),
+                'resume': self.application.manager.resumer.get_progress(),
+                'startup': startup.report.get_report(),
+                'loops': timers.get_stats()
             }
         return status
-    
+
+    def get_totals(self):
+        return self.application.manager.aggregator.get_totals()
+
     def add_download(self, d):
-        max_queued = int(self.get_setting('max_queued', 0))
-        if max_queued and (len(self.get_downloads()) >= max_queued):
+        self.store_download(d)
+        # Flush so the new row has its id before it's indexed; the
+        # commit itself is still left to the scheduler
+        self.store.flush()
+        self.commit()
+        self.index_download(d)
+        return d.id
+
+    # Fills in defaults and adds a new download to the store, without
+    # flushing it. pending counts earlier downloads of the same batch
+    # that aren't indexed yet.
+    def store_download(self, d, pending=0):
+        max_queued = self.get_int_setting('max_queued')
+        if max_queued and (len(self.get_downloads()) + pending >= max_queued):
             raise Exception('Too many downloads queued (see "max_queued" config var)')
 
         if d.url:
@@ -130,30 +107,31 @@ class Manager:
         d.added = time()
         d.deleted = False
         d.active = False
+        if d.priority is None:
+            d.priority = 0
         d.progress = 0
         d.status = Status.QUEUED
         d.downloaded = 0
 
         self.store.add(d)
-        self.get_downloads().append(d)
-        self.store.commit()
+
+    def index_download(self, d):
+        self.get_index().add(d)
         logging.info(u'Added new download ' + d.description)
         self.application.fire_event('download_added', d)
 
-        self.application.auto_queue()
-
-        return d.id
+    def get_index(self):
+        # Download index is shared by all managers, GlobalManager owns it
+        return self.application.manager.get_index()
 
     def get_downloads(self, flush=False):
-        if not self.downloads is None:
-            return self.downloads
         raise NotImplementedError('Manager must be subclassed')
 
     def get_download(self, id):
-        for d in self.get_downloads():
-            if d.id == id:
-                return d
-        raise Exception('Download not found')
+        d = self.get_index().get(id)
+        if d is None:
+            raise Exception('Download not found')
+        return d
 
     def pause_download(self, id):
         d = self.get_download(id)
@@ -166,7 +144,7 @@ class Manager:
             dfr.addErrback(self.update_status, d, Status.STOPPED)
         else:
             dfr = defer.succeed(True)
-        self.store.commit()
+        self.commit()
         return dfr
 
     def resume_download(self, id):
@@ -181,7 +159,7 @@ class Manager:
                     d.started = time()
             else:
                 dfr = defer.succeed(True)
-            self.store.commit()
+            self.commit()
             return dfr
         except Exception as e:
             d.status = Status.FAILED
@@ -199,14 +177,21 @@ class Manager:
     def remove_download_success(self, result, d, remove_files=True):
         if not d:
             return
+        self.detach_download(d)
+        self.flush()
+        self.clean_removed_download(d, remove_files)
+
+    # Drop the client and mark the download deleted, the caller commits
+    def detach_download(self, d):
         dc = self.get_download_client(d.id)
         if dc:
             dc.remove()
-            Manager.download_clients.remove(dc)
+            del Manager.download_clients[d.id]
         d.deleted = True
-        self.store.commit()
-        # Flush delete items out of local cache
-        self.get_downloads(True)
+        # Flush deleted items out of the download index
+        self.get_index().remove(d)
+
+    def clean_removed_download(self, d, remove_files=True):
         try:
             if remove_files:
                 workdir = self.get_work_directory(d)
@@ -230,32 +215,50 @@ class Manager:
             workdir = os.path.join(workdir, 'dldir%s' % download.id)
         return workdir
 
-    def get_download_client(self, id, create=False):
+    # Client classes are imported on first use, see download.registry
+    def get_client_name(self, d):
+        scheme = None
+        if d.url:
+            scheme = urlparse(d.url).scheme
+        return registry.get_name(d.mime_type, scheme)
+
+    def get_client_class(self, d):
+        name = self.get_client_name(d)
+        if name:
+            return registry.get_class(name)
+        return None
+
+    # prepared is passed to a new client, see DownloadClient.prepare()
+    def get_download_client(self, id, create=False, prepared=None):
         d = self.get_download(id)
-        for dc in Manager.download_clients:
-            if hasattr(dc, 'download') and dc.download.id == id:
-                return dc
+        if id in Manager.download_clients:
+            return Manager.download_clients[id]
 
         if create:
             try:
                 clientdir = self.get_work_directory(d)
-                client = None
-                if d.mime_type and d.mime_type in self.client_mimetypes:
-                    client = self.client_mimetypes[d.mime_type](d, self, clientdir)
-                elif d.url:
-                    protocol = urlparse(d.url).scheme
-                    if protocol in Manager.client_protocols:
-                        client = Manager.client_protocols[protocol](d, self, clientdir)
-                Manager.download_clients.append(client);
+                client = self.get_client_class(d)(d, self, clientdir, prepared)
+                Manager.download_clients[id] = client
                 client.addCallback(self.download_complete, client, d)
                 client.addErrback(self.download_failed, client, d)
                 return client
             except:
                 return None
 
+    # Existing client if there is one, otherwise a lightweight state
+    # object that answers is_running(), is_startable() etc.
+    def get_download_state(self, id):
+        d = self.get_download(id)
+        if id in Manager.download_clients:
+            return Manager.download_clients[id]
+        name = self.get_client_name(d)
+        if name:
+            return DownloadState(d, registry.get_capabilities(name))
+        return None
+
     def download_complete(self, new_mimetype, dc, d):
         if new_mimetype:
-            Manager.download_clients.remove(dc)
+            del Manager.download_clients[d.id]
             ndc = self.get_download_client(d.id, True)
             if ndc and dc.__class__ != ndc.__class__:
                 # New mimetype requires different download handler,
@@ -273,7 +276,7 @@ class Manager:
         d.active = False
         d.completed = time()
         d.status_message = None
-        self.store.commit()
+        self.commit()
         self.application.fire_event('download_complete', d)
         logging.info(u'Finished downloading %s (%s)' % (d.id, d.description))
         # NOTE: if upload_ratio is > 0, this will not get run until
@@ -293,27 +296,28 @@ class Manager:
             self.remove_download(d.id)
         self.application.fire_event('download_imported', d)
         logging.info(u'Imported %s (%s)' % (d.id, d.description))
-        self.store.commit()
+        self.commit()
 
     def process_download_failed(self, failure, d):
         d.status_message = unicode(failure.getErrorMessage())
         self.application.fire_event('download_import_failed', d, failure.value)
         logging.error(u'Import failed for %s (%s)' % (d.id, d.description))
         logging.error(str(failure))
-        self.store.commit()
+        self.commit()
 
     def download_failed(self, failure, dc, d):
         d.status = Status.FAILED
         d.active = False
         d.status_message = unicode(failure.getErrorMessage())
-        self.store.commit()
+        self.checkpoint(d)
+        self.commit()
         self.application.fire_event('download_failed', d, failure.value)
         logging.error(u'Download %s failed: %s' % (d.id, failure.getErrorMessage()))
 
-    def start_download(self, id, force=False):
+    def start_download(self, id, force=False, prepared=None):
         d = self.get_download(id)
         try:
-            dc = self.get_download_client(id, True)
+            dc = self.get_download_client(id, True, prepared)
             d.active = True
             d.status_message = None
             dfr = None
@@ -326,7 +330,7 @@ class Manager:
                     d.started = time()
             else:
                 dfr = defer.succeed(False)
-            self.store.commit()
+            self.commit()
             return dfr
         except Exception as e:
             d.status = Status.FAILED
@@ -334,9 +338,20 @@ class Manager:
             d.active = False
             self.application.fire_event('download_failed', d, e)
             logging.error(u'Download failed: %s' % d.status_message)
+            return defer.succeed(False)
+
+    def commit(self):
+        self.committer.commit()
+
+    def flush(self):
+        self.committer.flush()
+
+    # Write a download's live transfer counters into its columns
+    def checkpoint(self, d):
+        self.application.manager.runtime.checkpoint(d)
 
     def commit_store(self, result):
-        self.store.commit()
+        self.commit()
 
     def stop_download(self, id):
         d = self.get_download(id)
@@ -350,16 +365,85 @@ class Manager:
             dfr.addErrback(self.update_status, d, Status.STOPPED)
         else:
             dfr = defer.succeed(False)
-        self.store.commit()
+        self.commit()
         return dfr
 
+    # Bulk operations share a single commit and fire one consolidated
+    # downloads_* event with the affected downloads, in addition to the
+    # usual per-download events. Each returns a DeferredList.
+
+    def get_downloads_by_id(self, ids):
+        downloads = []
+        for id in ids:
+            try:
+                downloads.append(self.get_download(int(id)))
+            except Exception:
+                logging.debug(u'Skipping unknown download %s' % id)
+        return downloads
+
+    def bulk_add(self, downloads):
+        results = []
+        added = []
+        for d in downloads:
+            try:
+                self.store_download(d, len(added))
+                added.append(d)
+                results.append(d)
+            except Exception as e:
+                results.append(defer.fail(e))
+        # One flush assigns ids to the whole batch before it's indexed
+        self.store.flush()
+        for d in added:
+            self.index_download(d)
+        dl = [r if isinstance(r, defer.Deferred) else defer.succeed(r.id)
+            for r in results]
+        self.flush()
+        if len(added):
+            self.application.fire_event('downloads_added', added)
+        return defer.DeferredList(dl, consumeErrors=True)
+
+    def bulk_start(self, ids, force=False):
+        downloads = self.get_downloads_by_id(ids)
+        dl = [self.start_download(d.id, force) for d in downloads]
+        self.flush()
+        if len(downloads):
+            self.application.fire_event('downloads_started', downloads)
+        return defer.DeferredList(dl, consumeErrors=True)
+
+    def bulk_stop(self, ids):
+        downloads = self.get_downloads_by_id(ids)
+        dl = [self.stop_download(d.id) for d in downloads]
+        self.flush()
+        dfl = defer.DeferredList(dl, consumeErrors=True)
+        if len(downloads):
+            dfl.addCallback(self.application.event_callback,
+                'downloads_stopped', downloads)
+        return dfl
+
+    def bulk_remove(self, ids, remove_files=True):
+        downloads = self.get_downloads_by_id(ids)
+        dl = [self.stop_download(d.id) for d in downloads]
+        dfl = defer.DeferredList(dl, consumeErrors=True)
+        dfl.addCallback(self.bulk_remove_success, downloads, remove_files)
+        return dfl
+
+    def bulk_remove_success(self, result, downloads, remove_files=True):
+        for d in downloads:
+            self.detach_download(d)
+        self.flush()
+        for d in downloads:
+            self.clean_removed_download(d, remove_files)
+        if len(downloads):
+            self.application.fire_event('downloads_removed', downloads)
+        return result
+
     def pause(self):
         dfl = None
         if not self.paused:
             logging.info(u'Pausing all downloads')
             self.paused = True
             dl = [self.pause_download(d.id) for d in self.get_downloads() if d.active]
-            self.store.commit()
+            self.commit()
             dfl = defer.DeferredList(dl, consumeErrors=True)
         else:
             dfl = defer.DeferredList([defer.succeed(False)])
@@ -373,7 +457,8 @@ class Manager:
                 status = Status.COMPLETED
         d.status = status
         d.status_message = message
-        self.store.commit()
+        self.checkpoint(d)
+        self.commit()
 
     def resume(self):
         if self.paused:
@@ -381,14 +466,13 @@ class Manager:
             self.paused = False
             dl = [self.resume_download(d.id) \
                 for d in self.get_downloads() if d.active]
-            self.auto_queue()
             self.application.fire_event('downpour_resumed')
             return defer.DeferredList(dl, consumeErrors=True)
         return defer.DeferredList([defer.succeed(False)])
 
     def add_feed(self, f):
         self.store.add(f)
-        self.store.commit()
+        self.commit()
         self.application.fire_event('feed_added', f)
         logging.info(u'Added new feed ' + f.url)
         return f.id
@@ -396,12 +480,12 @@ class Manager:
     def check_feed_success(self, parsed, feed):
         if not feed.name or not len(feed.name):
             feed.name = parsed.feed.title
-        self.store.commit()
+        self.commit()
         logging.debug(u'Retrieved feed %s' % feed.name)
 
     def check_feed_failure(self, failure, feed):
         feed.last_error = unicode(failure.getErrorMessage())
-        self.store.commit()
+        self.commit()
         logging.error(u'Feed retrieval failed: %s' % feed.name)
 
     def get_feeds(self):
@@ -417,11 +501,16 @@ class Manager:
         f = self.get_feed(id)
         # Delete from database
         self.store.remove(f)
-        self.store.commit()
+        self.commit()
         self.application.fire_event('feed_removed', f)
         logging.info(u'Removed feed %s (%s)' % (f.id, f.name))
         return True
 
+    # Drop cached views, they are reloaded on next use
+    def invalidate(self, *caches):
+        for cache in caches:
+            setattr(self, cache, None)
+
     def get_library(self, id=None, media_type=None):
         for l in self.get_libraries():
             if id and l.id == id:
@@ -439,6 +528,12 @@ class Manager:
     def get_setting(self, name, default=None):
         return self.application.get_setting(name, default);
 
+    def get_int_setting(self, name, default=0):
+        return self.application.settings.get_int(name, default)
+
+    def get_float_setting(self, name, default=0.0):
+        return self.application.settings.get_float(name, default)
+
     def get_user_directory(self):
         return os.path.expanduser(self.get_option(('downpour', 'user_directory'), '~/Downloads'))
 
@@ -456,126 +551,216 @@ class GlobalManager(Manager):
 
     upload_rate_filter = None
     download_rate_filter = None
+    index = None
+    queue_pending = None
+    scheduling_policy = None
+
+    def __init__(self, application):
+        Manager.__init__(self, application)
+        self.user_rate_filters = {}
+        self.runtime = RuntimeTable(self, self.get_index(),
+            int(self.get_option(('downpour', 'checkpoint_interval'), 60)))
+        self.runtime.start()
+        self.aggregator = StatusAggregator(self.get_index())
+        self.sampler = HostSampler(self)
+        self.sampler.start()
+        self.allocator = BandwidthAllocator(self,
+            int(self.get_option(('downpour', 'bandwidth_interval'), 5)))
+        self.allocator.start()
+        self.maintenance = MaintenanceJob(self,
+            os.path.expanduser(self.get_option(('downpour', 'state'))),
+            int(self.get_option(('downpour', 'maintenance_interval'), 86400)),
+            int(self.get_option(('downpour', 'archive_retention'), 30)))
+        self.maintenance.start()
+        self.resumer = ResumePipeline(self,
+            int(self.get_option(('downpour', 'resume_rate'), 5)),
+            int(self.get_option(('downpour', 'resume_threads'), 2)))
+
+        # Apply setting changes as they happen instead of re-reading
+        # settings on every use
+        settings = application.settings
+        for name in ('upload_rate', 'download_rate', 'connection_limit'):
+            settings.subscribe(name, self.bandwidth_setting_changed)
+        for name in ('max_active', 'queue_policy'):
+            settings.subscribe(name, self.schedule_auto_queue)
+
+    # Resume downloads from the previous session in the background
+    def resume_session(self):
+        return self.resumer.start([d for d in self.get_downloads() if d.active])
+
+    def bandwidth_setting_changed(self, name, old_value, new_value):
+        rate = self.get_int_setting(name) * 1024
+        rf = None
+        if name == 'upload_rate':
+            rf = self.upload_rate_filter
+        elif name == 'download_rate':
+            rf = self.download_rate_filter
+        if rf:
+            rf.rate = rate
+            rf.capacity = rate * 5
+        self.allocator.allocate()
+
+    # Event listener, collapses bursts of queue triggers into a single
+    # auto_queue() run on the next reactor turn
+    def schedule_auto_queue(self, *args):
+        if self.queue_pending is None:
+            self.queue_pending = reactor.callLater(0, self.run_scheduled_auto_queue)
+
+    def run_scheduled_auto_queue(self):
+        self.queue_pending = None
+        self.auto_queue()
 
     # Start as many downloads as allowed by current configuration,
     # in the order they were added
     def auto_queue(self):
         if not self.application.is_paused():
             logging.debug(u'Running auto-queue')
-            status = self.get_status()
-
-            active = status['active_downloads']
-            ulrate = status['uploadrate']
-            dlrate = status['downloadrate']
-            conn = status['connections']
-
-            max_active = int(self.get_setting('max_active', 0))
-            max_ulrate = int(self.get_setting('upload_rate', 0)) * 1024
-            max_dlrate = int(self.get_setting('download_rate', 0)) * 1024
-            max_conn = int(self.get_setting('connection_limit', 0))
-
-            downloads = self.get_downloads()[:]
-
-            # TODO make this fairly distributed among users
-            for d in filter(lambda x: x.status == Status.QUEUED and not x.active, downloads):
-                if not max_active or active < max_active:
-                    self.start_download(d.id)
-                    active = active + 1
-
-            self.store.commit()
-
-            # Auto stop downloads if we're over config limits
-            if max_active and active > max_active:
-                downloads.reverse()
-                for d in filter(lambda x: x.active, downloads):
-                    if active > max_active:
-                        sdfr = self.stop_download(d.id)
-                        sdfr.addCallback(self.update_status, d, Status.QUEUED)
-                        sdfr.addErrback(self.update_status, d, Status.QUEUED)
-                        active = active - 1;
-                    else:
-                        break
-
-            if active > 0:
-                # Reset transfer limits
-                if max_ulrate > 0:
-                    client_ulrate = int(max_ulrate / active)
-                    for d in filter(lambda x: x.active, downloads):
-                        dc = self.get_download_client(d.id)
-                        if (dc):
-                            dc.set_upload_rate(client_ulrate)
-                if max_dlrate > 0:
-                    client_dlrate = int(max_dlrate / active)
-                    for d in filter(lambda x: x.active, downloads):
-                        dc = self.get_download_client(d.id)
-                        if (dc):
-                            dc.set_download_rate(client_dlrate)
-                if max_conn > 0:
-                    client_conn = int(max_conn / active)
-                    for d in filter(lambda x: x.active, downloads):
-                        dc = self.get_download_client(d.id)
-                        if (dc):
-                            dc.set_max_connections(client_conn)
+
+            max_active = self.get_int_setting('max_active')
+
+            downloads = self.get_downloads()
+            running = filter(lambda x: x.active, downloads)
+            queued = filter(lambda x: not x.active,
+                self.index.with_status(Status.QUEUED))
+
+            # Slots are shared fairly among users, see scheduling.py
+            (to_start, to_stop) = self.get_scheduling_policy().schedule(
+                running, queued, max_active)
+
+            for d in to_start:
+                self.start_download(d.id)
+
+            self.commit()
+
+            # Auto stop downloads if we're over config limits, or if
+            # they were preempted by higher ranked downloads
+            for d in to_stop:
+                sdfr = self.stop_download(d.id)
+                sdfr.addCallback(self.update_status, d, Status.QUEUED)
+                sdfr.addErrback(self.update_status, d, Status.QUEUED)
+
+            # Share transfer limits among the new set of active downloads
+            self.allocator.allocate()
+
+    # Policy can be plugged in directly, otherwise it is selected
+    # by the "queue_policy" setting
+    def get_scheduling_policy(self):
+        if self.scheduling_policy:
+            return self.scheduling_policy
+        return scheduling.get_policy(self.get_setting('queue_policy', 'oldest'))
+
+    def set_scheduling_policy(self, policy):
+        self.scheduling_policy = policy
+        self.schedule_auto_queue()
+
+    def get_index(self):
+        if self.index is None:
+            self.index = DownloadIndex(self.store.find(models.Download,
+                models.Download.deleted == False).order_by(models.Download.added))
+        return self.index
 
     def get_downloads(self, flush=False):
-        return list(self.store.find(models.Download,
-            models.Download.deleted == False).order_by(models.Download.added))
+        return self.get_index().all()
 
     def get_feeds(self):
         if self.feeds is None:
             self.feeds = list(self.store.find(models.Feed).order_by(models.Feed.name))
         return self.feeds
 
+    # Per-user sharing rate filters (User.share_max_rate), throttled
+    # by the global upload rate filter
+    def get_user_upload_rate_filter(self, user):
+        if not user.share_max_rate:
+            return self.get_upload_rate_filter()
+        max_ulrate = user.share_max_rate * 1024
+        if not user.id in self.user_rate_filters:
+            self.user_rate_filters[user.id] = ThrottledBucketFilter(
+                max_ulrate, self.get_upload_rate_filter())
+        else:
+            rf = self.user_rate_filters[user.id]
+            rf.rate = max_ulrate
+            rf.capacity = max_ulrate * 5
+        return self.user_rate_filters[user.id]
+
+    # Rates are kept current by bandwidth_setting_changed()
     def get_upload_rate_filter(self):
-        max_ulrate = int(self.get_setting('upload_rate', 0)) * 1024
         if not self.upload_rate_filter:
-            self.upload_rate_filter = ThrottledBucketFilter(max_ulrate)
-        else:
-            self.upload_rate_filter.rate = max_ulrate
+            self.upload_rate_filter = ThrottledBucketFilter(
+                self.get_int_setting('upload_rate') * 1024)
         return self.upload_rate_filter
 
     def get_download_rate_filter(self):
-        max_dlrate = int(self.get_setting('download_rate', 0)) * 1024
         if not self.download_rate_filter:
-            self.download_rate_filter = ThrottledBucketFilter(max_dlrate)
-        else:
-            self.download_rate_filter.rate = max_dlrate
+            self.download_rate_filter = ThrottledBucketFilter(
+                self.get_int_setting('download_rate') * 1024)
         return self.download_rate_filter
 
 class UserManager(Manager):
 
+    downloads = None
+    library_directory = None
+
     def __init__(self, application, user):
         Manager.__init__(self, application)
         self.user = user
+        # Follow index changes to keep the download view current
+        self.get_index().add_listener(self)
 
-    def add_download(self, d):
+    def detach(self):
+        self.get_index().remove_listener(self)
+
+    # DownloadIndex listener
+    def added(self, d):
+        self.downloads = None
+
+    def removed(self, d):
+        self.downloads = None
+
+    def changed(self, d, name, old_value, new_value):
+        if name == 'user_id':
+            self.downloads = None
+
+    # Used by both add_download() and bulk_add()
+    def store_download(self, d, pending=0):
         d.user = self.user
-        return Manager.add_download(self, d)
+        return Manager.store_download(self, d, pending)
 
+    # Callers get a copy, the cached view is shared between requests
     def get_downloads(self, flush=False):
+        if self.downloads is None or flush:
+            if self.user.admin:
+                self.downloads = self.get_index().all()
+            else:
+                self.downloads = self.get_index().for_user(self.user.id)
+        return list(self.downloads)
+
+    def get_totals(self):
         if self.user.admin:
-            return list(self.store.find(models.Download,
-                models.Download.deleted == False
-                ).order_by(models.Download.added))
-        elif self.downloads is None or flush:
-            self.downloads = list(self.store.find(models.Download,
-                models.Download.deleted == False,
-                models.Download.user_id == self.user.id
-                ).order_by(models.Download.added))
-        return self.downloads
+            return Manager.get_totals(self)
+        return self.application.manager.aggregator.get_totals(self.user.id)
+
+    def get_download(self, id):
+        d = Manager.get_download(self, id)
+        if not self.user.admin and d.user_id != self.user.id:
+            raise Exception('Download not found')
+        return d
+
+    def get_upload_rate_filter(self):
+        return self.application.manager.get_user_upload_rate_filter(self.user)
 
     def add_feed(self, f):
         f.user = self.user
         return Manager.add_feed(self, f)
 
     def get_feeds(self):
-        if self.user.admin:
-            return list(self.store.find(models.Feed
-                ).order_by(models.Feed.name))
-        elif self.feeds is None:
-            return list(self.store.find(models.Feed,
-                models.Feed.user_id == self.user.id
-                ).order_by(models.Feed.name))
+        if self.feeds is None:
+            if self.user.admin:
+                self.feeds = list(self.store.find(models.Feed
+                    ).order_by(models.Feed.name))
+            else:
+                self.feeds = list(self.store.find(models.Feed,
+                    models.Feed.user_id == self.user.id
+                    ).order_by(models.Feed.name))
         return self.feeds
 
     def get_libraries(self):
@@ -586,15 +771,17 @@ class UserManager(Manager):
         return self.libraries
 
     def get_library_directory(self):
-        userdir = self.user.directory
-        if not userdir:
-            userdir = '%s/%s' % (self.get_user_directory(), self.user.username)
-        userdir = os.path.expanduser(userdir)
-        if userdir[0] != '/':
-            userdir = '%s/%s' % (os.getcwd(), userdir)
-        if not os.path.exists(userdir):
-            os.mkdir(userdir)
-        return userdir
+        if self.library_directory is None:
+            userdir = self.user.directory
+            if not userdir:
+                userdir = '%s/%s' % (self.get_user_directory(), self.user.username)
+            userdir = os.path.expanduser(userdir)
+            if userdir[0] != '/':
+                userdir = '%s/%s' % (os.getcwd(), userdir)
+            if not os.path.exists(userdir):
+                os.mkdir(userdir)
+            self.library_directory = userdir
+        return self.library_directory
 
     def get_full_path(self, path, media_type=None):
         parts = [self.get_library_directory()]
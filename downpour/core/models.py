@@ -1,5 +1,118 @@
 from downpour.download import Status
 from storm.locals import *
+from storm.info import get_obj_info
+from downpour.core.runtime import get_state
+from downpour.core import blobs
+
+# Attribute kept in the object's runtime TransferState record, if it has
+# one, that announces changes on the object's Storm event system so
+# in-memory aggregates can follow them. Persistent attributes fall back
+# to (and are checkpointed into) the Storm column named '_' + name.
+class Transient(object):
+
+    def __init__(self, name, persistent=False, default=0):
+        self.name = name
+        self.persistent = persistent
+        self.default = default
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        state = get_state(obj)
+        if state is not None:
+            return getattr(state, self.name)
+        if self.persistent:
+            return getattr(obj, '_' + self.name)
+        return obj.__dict__.get(self.name, self.default)
+
+    def __set__(self, obj, value):
+        state = get_state(obj)
+        if state is None and self.persistent:
+            setattr(obj, '_' + self.name, value)
+            return
+        old_value = self.__get__(obj)
+        if state is not None:
+            setattr(state, self.name, value)
+        else:
+            obj.__dict__[self.name] = value
+        if old_value != value:
+            get_obj_info(obj).event.emit('transient-changed',
+                self.name, old_value, value)
+
+# Large binary attribute kept out of row in the blobs table, the object
+# only holds the blob key. Loaded from the store each time it is read.
+class BlobAttribute(object):
+
+    def __init__(self, name, column, keyfunc):
+        self.name = name
+        self.column = column
+        self.keyfunc = keyfunc
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        pending = obj.__dict__.get('_pending_blobs', {})
+        if self.name in pending:
+            return pending[self.name]
+        key = getattr(obj, self.column)
+        store = Store.of(obj)
+        if key is None or store is None:
+            return None
+        blob = store.get(Blob, key)
+        if blob is None:
+            return None
+        return blobs.decompress(blob.data)
+
+    def __set__(self, obj, value):
+        if value is None:
+            setattr(obj, self.column, None)
+            return
+        value = str(value)
+        setattr(obj, self.column, self.keyfunc(obj, value))
+        if Store.of(obj) is None:
+            # Written by write_pending_blobs() when the object is flushed
+            obj.__dict__.setdefault('_pending_blobs', {})[self.name] = value
+        else:
+            self.write(obj, value)
+
+    def write(self, obj, value):
+        store = Store.of(obj)
+        key = getattr(obj, self.column)
+        if key.startswith(u'torrent:') or key.startswith(u'sha1:'):
+            # Content-addressed, so an existing row never changes. Always
+            # insert instead of trusting a cached lookup, since
+            # maintenance may have purged the row on another connection.
+            store.execute('INSERT OR IGNORE INTO blobs (id, data, size) '
+                'VALUES (?, ?, ?)', (key, blobs.compress(value), len(value)),
+                noresult=True)
+            return
+        blob = store.get(Blob, key)
+        if blob is None:
+            blob = Blob()
+            blob.id = key
+            store.add(blob)
+        blob.data = blobs.compress(value)
+        blob.size = len(value)
+
+# Called while the store is flushing, so lookups must not flush again
+def write_pending_blobs(obj):
+    pending = obj.__dict__.pop('_pending_blobs', {})
+    if pending:
+        store = Store.of(obj)
+        store.block_implicit_flushes()
+        try:
+            for name in pending:
+                getattr(obj.__class__, name).write(obj, pending[name])
+        finally:
+            store.unblock_implicit_flushes()
+
+class Blob(object):
+
+    __storm_table__ = 'blobs'
+
+    id = Unicode(primary=True)
+    data = RawStr()
+    size = Int()
 
 class State(object):
 
@@ -106,16 +219,22 @@ class Download(object):
     media_type = Unicode()
     mime_type = Unicode()
     description = Unicode()
-    metadata = RawStr()
+    metadata_key = Unicode()
     info_hash = RawStr()
-    resume_data = RawStr()
+    resume_key = Unicode()
     active = Bool()
     status = Int()
-    status_message = Unicode()
-    progress = Float()
-    size = Int()
-    downloaded = Int()
-    uploaded = Int()
+    _status_message = Unicode('status_message')
+    priority = Int()
+    # Per-download limits (KB/s), 0 or None for none; seed ratio
+    # overrides the upload_ratio setting if set
+    max_rate = Int()
+    max_upload_rate = Int()
+    seed_ratio = Float()
+    _progress = Float('progress')
+    _size = Int('size')
+    _downloaded = Int('downloaded')
+    _uploaded = Int('uploaded')
     added = Int()
     started = Int()
     completed = Int()
@@ -125,13 +244,28 @@ class Download(object):
     user = Reference(user_id, User.id)
     feed = Reference(feed_id, Feed.id)
 
+    # Out-of-row blobs, see core.blobs
+    metadata = BlobAttribute('metadata', 'metadata_key', blobs.torrent_key)
+    resume_data = BlobAttribute('resume_data', 'resume_key', blobs.download_key)
+
+    def __storm_pre_flush__(self):
+        write_pending_blobs(self)
+
+    # Live transfer counters, see core.runtime
+    status_message = Transient('status_message', True)
+    progress = Transient('progress', True)
+    size = Transient('size', True)
+    downloaded = Transient('downloaded', True)
+    uploaded = Transient('uploaded', True)
+
     # Non-persistent fields
-    health = 0
-    uploadrate = 0
-    downloadrate = 0
-    connections = 0
-    elapsed = 0
-    timeleft = 0
+    health = Transient('health')
+    uploadrate = Transient('uploadrate')
+    downloadrate = Transient('downloadrate')
+    connections = Transient('connections')
+    elapsed = Transient('elapsed')
+    timeleft = Transient('timeleft')
+    seed_progress = Transient('seed_progress')
     importing = False
 
 class FeedItem(object):
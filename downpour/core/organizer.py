@@ -209,7 +209,7 @@ def process_download(manager, download, client):
             download.files.add(f)
         dfr = import_files(download, manager, library, firstRun=True)
 
-    manager.store.commit()
+    manager.commit()
 
     return dfr
 
@@ -0,0 +1,167 @@
+from downpour.core import models, blobs
+from downpour.download import Status
+from twisted.internet import defer, task, reactor, threads
+from twisted.python.threadpool import ThreadPool
+from time import time
+import logging
+
+# Resumes the downloads that were active in the previous session without
+# blocking startup. Metadata is loaded and parsed in a thread pool (see
+# DownloadClient.prepare()), and prepared downloads are admitted to their
+# clients at a limited rate so they don't all hash check and announce at
+# once. Admission is ordered, not deferred: transfers that were in
+# progress go first, and idle (queued, seeding or finished) downloads are
+# admitted at the same rate once they're all in.
+class ResumePipeline(object):
+
+    idle_statuses = (Status.QUEUED, Status.SEEDING, Status.COMPLETED)
+
+    def __init__(self, manager, rate=5, threads=2):
+        self.manager = manager
+        self.rate = rate
+        self.threads = threads
+        self.pool = None
+        self.loop = None
+        self.deferred = None
+        # Download ids in admission order, and prepared results by id
+        self.order = []
+        self.waiting = []
+        self.ready = {}
+        self.preparing = 0
+        self.total = 0
+        self.admitted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.idle = 0
+        self.started = None
+        self.finished = None
+
+    def is_idle(self, d):
+        return d.status in self.idle_statuses or d.progress == 100
+
+    # Returns a Deferred that fires once every download was admitted
+    def start(self, downloads):
+        transferring = [d.id for d in downloads if not self.is_idle(d)]
+        idle = [d.id for d in downloads if self.is_idle(d)]
+        self.order = transferring + idle
+        self.waiting = list(self.order)
+        self.total = len(self.order)
+        self.idle = len(idle)
+        self.started = time()
+        self.deferred = defer.Deferred()
+        logging.info('Resuming %d downloads (%d idle ones last)' % (self.total, self.idle))
+
+        if self.total:
+            self.pool = ThreadPool(1, self.threads, 'downpour-resume')
+            self.pool.start()
+            self.fill()
+            self.loop = task.LoopingCall(self.admit)
+            self.loop.start(1.0, False)
+        else:
+            self.done()
+        return self.deferred
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        if self.pool:
+            self.pool.stop()
+            self.pool = None
+        self.waiting = []
+
+    def is_running(self):
+        return self.started is not None and self.finished is None
+
+    def get_progress(self):
+        elapsed = (self.finished or time()) - self.started if self.started else 0
+        return {'running': self.is_running(),
+                'total': self.total,
+                'admitted': self.admitted,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'idle': self.idle,
+                'pending': self.total - self.admitted - self.skipped,
+                'elapsed': elapsed}
+
+    # Keep a bounded number of downloads prepared ahead of admission,
+    # so parsed metadata doesn't pile up in memory
+    def fill(self):
+        limit = self.threads + self.rate
+        while self.waiting and self.preparing + len(self.ready) < limit:
+            id = self.waiting.pop(0)
+            self.preparing += 1
+            dfr = self.prepare(id)
+            dfr.addErrback(self.prepare_failed, id)
+            dfr.addCallback(self.prepared, id)
+
+    def prepare(self, id):
+        d = self.manager.get_index().get(id)
+        if d is None:
+            return defer.succeed(None)
+        cls = self.manager.get_client_class(d)
+        if not cls or not d.metadata_key:
+            return defer.succeed(None)
+        dfr = self.manager.application.get_data_access().snapshot(
+            load_metadata, d.metadata_key)
+        dfr.addCallback(self.parse, cls)
+        return dfr
+
+    def parse(self, metadata, cls):
+        if metadata is None or not self.pool:
+            return None
+        return threads.deferToThreadPool(reactor, self.pool, cls.prepare, metadata)
+
+    def prepare_failed(self, failure, id):
+        # The client will parse (and report errors) on its own
+        logging.debug('Could not prepare download %s: %s' % (id, failure.getErrorMessage()))
+        return None
+
+    def prepared(self, result, id):
+        self.preparing -= 1
+        self.ready[id] = result
+
+    def admit(self):
+        count = 0
+        while self.order and count < self.rate:
+            id = self.order[0]
+            if not id in self.ready:
+                break
+            self.order.pop(0)
+            prepared = self.ready.pop(id)
+            count += 1
+            d = self.manager.get_index().get(id)
+            # Stopped, removed or started by hand in the meantime. Viewing
+            # a download creates its client too, so only skip clients that
+            # are actually running or starting.
+            dc = d and self.manager.get_download_client(id)
+            if d is None or d.deleted or not d.active or \
+                    (dc and dc.is_stoppable()):
+                self.skipped += 1
+                continue
+            dfr = self.manager.start_download(id, True, prepared)
+            dfr.addCallback(self.resumed, id)
+            self.admitted += 1
+        self.fill()
+        if not self.order:
+            self.done()
+
+    def resumed(self, started, id):
+        if not started:
+            d = self.manager.get_index().get(id)
+            if d and d.status == Status.FAILED:
+                self.failed += 1
+
+    def done(self):
+        self.stop()
+        self.finished = time()
+        logging.info('Resumed %d downloads in %.1fs' % (self.admitted,
+            self.finished - self.started))
+        if self.deferred and not self.deferred.called:
+            self.deferred.callback(self.get_progress())
+
+# Runs on a database reader thread
+def load_metadata(store, key):
+    blob = store.get(models.Blob, key)
+    if blob is None:
+        return None
+    return blobs.decompress(blob.data)
@@ -0,0 +1,94 @@
+from twisted.internet import task
+
+# Live transfer counters of a download. Download clients update these
+# every few seconds, so they are kept in a compact record outside of the
+# Storm object and its dirty tracking.
+class TransferState(object):
+
+    __slots__ = ('size', 'downloaded', 'uploaded', 'progress',
+        'status_message', 'downloadrate', 'uploadrate', 'connections',
+        'elapsed', 'timeleft', 'health', 'seed_progress')
+
+    # Counters that are checkpointed into Download columns
+    persistent = ('size', 'downloaded', 'uploaded', 'progress',
+        'status_message')
+
+    def __init__(self):
+        for f in self.__slots__:
+            setattr(self, f, 0)
+
+def get_state(d):
+    return d.__dict__.get('_transfer', None)
+
+# Runtime state table of all live downloads, keyed by download id. As a
+# DownloadIndex listener it attaches a TransferState to every indexed
+# download, and checkpoints the persistent counters back into the Storm
+# object on status changes, on removal and every interval seconds.
+class RuntimeTable(object):
+
+    def __init__(self, manager, index, interval=60):
+        self.manager = manager
+        self.index = index
+        self.interval = interval
+        self.states = {}
+        self.checkpoints = 0
+        self.loop = None
+        index.add_listener(self)
+
+    def start(self):
+        self.loop = task.LoopingCall(self.checkpoint_all)
+        self.loop.start(self.interval, False)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def get(self, id):
+        return self.states.get(id, None)
+
+    def added(self, d):
+        state = TransferState()
+        for f in TransferState.persistent:
+            setattr(state, f, getattr(d, '_' + f))
+        self.states[d.id] = state
+        d.__dict__['_transfer'] = state
+
+    def removed(self, d):
+        self.checkpoint(d)
+        if d.id in self.states:
+            del self.states[d.id]
+        del d.__dict__['_transfer']
+
+    def changed(self, d, name, old_value, new_value):
+        if name in ('status', 'active'):
+            self.checkpoint(d)
+
+    # Copy the persistent counters into the download's columns, returning
+    # whether any column changed
+    def checkpoint(self, d):
+        state = self.states.get(d.id, None)
+        if state is None:
+            return False
+        changed = False
+        for f in TransferState.persistent:
+            value = getattr(state, f)
+            if getattr(d, '_' + f) != value:
+                setattr(d, '_' + f, value)
+                changed = True
+        if changed:
+            self.checkpoints += 1
+        return changed
+
+    def checkpoint_all(self):
+        changed = False
+        for id in self.states.keys():
+            d = self.index.get(id)
+            if d is not None and self.checkpoint(d):
+                changed = True
+        # Idle transfers don't need an (empty) commit
+        if changed:
+            self.manager.commit()
+
+    def get_stats(self):
+        return {'downloads': len(self.states),
+                'checkpoints': self.checkpoints}
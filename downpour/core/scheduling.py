@@ -0,0 +1,163 @@
+from downpour.core.fairness import fair_slots
+
+# Download queue scheduling policies. A policy ranks downloads and
+# decides which queued downloads to start and which running ones to
+# stop when the active download limit or a user's limit is exceeded.
+class SchedulingPolicy(object):
+
+    name = None
+    description = None
+
+    # Preemptive policies let a queued download displace a running
+    # download that ranks clearly below it, see preempts()
+    preemptive = False
+
+    def key(self, d):
+        raise NotImplementedError
+
+    def order(self, downloads):
+        return sorted(downloads, key=self.key)
+
+    # Whether a queued download should take a running download's slot.
+    # Policies require a clear lead here so that downloads ranked about
+    # the same don't keep displacing each other.
+    def preempts(self, queued, running):
+        return False
+
+    # Relative share of download slots for a user when several users
+    # are competing for them
+    def weight(self, user):
+        return 1
+
+    # Per-user concurrent download cap (User.max_downloads, 0 = unlimited)
+    def user_cap(self, user):
+        if user and user.max_downloads:
+            return user.max_downloads
+        return None
+
+    # Returns a (to_start, to_stop) tuple of download lists. Download
+    # slots are shared out between users with weighted max-min fairness,
+    # and the policy ranks each user's own downloads.
+    def schedule(self, running, queued, max_active):
+        slots = max_active or None
+
+        users = {}
+        byuser = {}
+        for d in running + queued:
+            if not d.user_id in byuser:
+                users[d.user_id] = d.user
+                byuser[d.user_id] = ([], [])
+            if d.active:
+                byuser[d.user_id][0].append(d)
+            else:
+                byuser[d.user_id][1].append(d)
+
+        caps = {}
+        weights = {}
+        for u in users:
+            caps[u] = self.user_cap(users[u])
+            weights[u] = self.weight(users[u])
+        def capped(u, n):
+            if caps[u] is None:
+                return n
+            return min(n, caps[u])
+
+        to_start = []
+        to_stop = []
+
+        if self.preemptive:
+            demands = dict([(u, capped(u, len(byuser[u][0]) + len(byuser[u][1])))
+                for u in byuser])
+            alloc = fair_slots(slots, demands, weights)
+            for u in byuser:
+                (start, stop) = self.preempt(byuser[u][0], byuser[u][1], alloc[u])
+                to_start.extend(start)
+                to_stop.extend(stop)
+        else:
+            # Running downloads keep their slots unless a limit is exceeded,
+            # only the remaining capacity is shared out
+            held = dict([(u, capped(u, len(byuser[u][0]))) for u in byuser])
+            held = fair_slots(slots, held, weights)
+            free = None
+            if slots is not None:
+                free = slots - sum(held.values())
+            demands = dict([(u, min(len(byuser[u][1]),
+                capped(u, len(byuser[u][0]) + len(byuser[u][1])) - held[u]))
+                for u in byuser])
+            extra = fair_slots(free, demands, weights, held)
+            for u in byuser:
+                to_stop.extend(self.order(byuser[u][0])[held[u]:])
+                to_start.extend(self.order(byuser[u][1])[:max(extra[u], 0)])
+
+        return (self.order(to_start), to_stop)
+
+    # Running downloads keep their slots up to the allocation, free slots
+    # go to the best queued downloads, and the rest of the queue only
+    # displaces running downloads that it preempts
+    def preempt(self, running, queued, alloc):
+        kept = self.order(running)
+        stop = kept[alloc:]
+        kept = kept[:alloc]
+        queued = self.order(queued)
+        free = alloc - len(kept)
+        start = queued[:free]
+        queued = queued[free:]
+        while queued and kept and self.preempts(queued[0], kept[-1]):
+            start.append(queued.pop(0))
+            stop.append(kept.pop())
+        return (start, stop)
+
+class OldestFirstPolicy(SchedulingPolicy):
+
+    name = 'oldest'
+    description = 'Oldest first'
+
+    def key(self, d):
+        return (d.added, d.id)
+
+class PriorityPolicy(SchedulingPolicy):
+
+    name = 'priority'
+    description = 'Highest priority first'
+    preemptive = True
+
+    def key(self, d):
+        return (-(d.priority or 0), d.added, d.id)
+
+    # Only a strictly higher priority, not age within the same priority
+    def preempts(self, queued, running):
+        return (queued.priority or 0) > (running.priority or 0)
+
+class ShortestRemainingPolicy(SchedulingPolicy):
+
+    name = 'shortest'
+    description = 'Shortest remaining first'
+    preemptive = True
+
+    # A queued download must have this much less left than a running
+    # one to displace it
+    margin = 0.25
+
+    def remaining(self, d):
+        # Downloads of unknown size go last
+        if d.size:
+            return d.size - (d.downloaded or 0)
+        return float('inf')
+
+    def key(self, d):
+        return (self.remaining(d), d.added, d.id)
+
+    def preempts(self, queued, running):
+        return self.remaining(queued) < self.remaining(running) * (1 - self.margin)
+
+# Add new policies to this dict
+policies = {
+    OldestFirstPolicy.name: OldestFirstPolicy,
+    PriorityPolicy.name: PriorityPolicy,
+    ShortestRemainingPolicy.name: ShortestRemainingPolicy
+}
+
+def get_policy(name):
+    if name in policies:
+        return policies[name]()
+    return OldestFirstPolicy()
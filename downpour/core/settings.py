@@ -0,0 +1,76 @@
+import logging
+
+# Name/value rows of a settings-like table (models.Setting, models.State)
+# held in a dict. Typed accessors cache the parsed value until the
+# setting changes, and subscribers are notified only when a value
+# actually changes.
+class SettingsService(object):
+
+    def __init__(self, store, model):
+        self.store = store
+        self.model = model
+        self.rows = dict([(r.name, r) for r in store.find(model)])
+        self.parsed = {}
+        self.subscribers = {}
+
+    def get(self, name, default=None):
+        if name in self.rows:
+            return self.rows[name].value
+        return default
+
+    def get_int(self, name, default=0):
+        return self.get_typed(name, int, default)
+
+    def get_float(self, name, default=0.0):
+        return self.get_typed(name, float, default)
+
+    def get_bool(self, name, default=False):
+        return self.get_typed(name, self.parse_bool, default)
+
+    def get_typed(self, name, parse, default):
+        key = (name, parse)
+        if not key in self.parsed:
+            value = self.get(name, None)
+            if value is None or value == u'':
+                return default
+            try:
+                self.parsed[key] = parse(value)
+            except ValueError:
+                logging.warning('Invalid value for setting %s: %s' % (name, value))
+                return default
+        return self.parsed[key]
+
+    def parse_bool(self, value):
+        return value.lower() in (u'1', u'true', u'yes', u'on')
+
+    def all(self):
+        return dict([(name, self.rows[name].value) for name in self.rows])
+
+    def set(self, name, value):
+        value = unicode(value)
+        old_value = self.get(name)
+        if old_value == value:
+            return
+        row = self.rows.get(name, None)
+        if row is None:
+            row = self.model()
+            row.name = name
+            self.rows[name] = row
+            self.store.add(row)
+        row.value = value
+        self.store.commit()
+        for key in self.parsed.keys():
+            if key[0] == name:
+                del self.parsed[key]
+        for callback in self.subscribers.get(name, []) + self.subscribers.get(None, []):
+            try:
+                callback(name, old_value, value)
+            except Exception as e:
+                logging.error('Caught error in setting subscriber: %s' % e)
+
+    # Call callback(name, old_value, new_value) when the named setting
+    # changes, or on any change if name is None
+    def subscribe(self, name, callback):
+        if not name in self.subscribers:
+            self.subscribers[name] = []
+        self.subscribers[name].append(callback)
@@ -10,18 +10,66 @@ except ImportError:
     except ImportError:
         sqlite = Dummy
 
+# Connection profiles, selected with the "profile" URI option. Any pragma
+# can also be set on its own with a URI option of the same name, e.g.
+# sqlite:/var/lib/downpour/downpour.db?profile=performance&cache_size=-64000
+profiles = {
+    # SQLite defaults (rollback journal)
+    'compatible': {
+        'journal_mode': 'DELETE'
+    },
+    # Readers don't block behind commits in WAL mode, and NORMAL sync
+    # is still crash-safe with WAL (only the last commits may be lost
+    # on power failure)
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 1000
+    }
+}
+
+# Applied in this order, journal_mode first since it affects the others
+pragmas = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+    'temp_store', 'wal_autocheckpoint')
+
+def get_pragmas(options):
+    values = dict(profiles.get(options.get('profile', 'performance'), {}))
+    for name in pragmas:
+        if name in options:
+            values[name] = options[name]
+    return values
+
+def configure(raw_connection, values):
+    for name in pragmas:
+        if name in values and values[name] is not None:
+            raw_connection.execute("PRAGMA %s = %s" % (name, values[name]))
+
+# Copy WAL contents back into the database file from a separate
+# connection. PASSIVE never blocks readers or writers.
+def checkpoint(filename, mode='PASSIVE'):
+    raw_connection = sqlite.connect(filename, isolation_level=None)
+    try:
+        return raw_connection.execute("PRAGMA wal_checkpoint(%s)" % mode).fetchone()
+    finally:
+        raw_connection.close()
+
 class SQLiteFK(SQLite):
 
     def __init__(self, uri):
         SQLite.__init__(self, uri)
+        self._pragmas = get_pragmas(uri.options)
+        # Storm's own synchronous option still applies
+        if self._synchronous is not None:
+            self._pragmas['synchronous'] = self._synchronous
 
     def raw_connect(self):
         # See the story at the end to understand why we set isolation_level.
         raw_connection = sqlite.connect(self._filename, timeout=self._timeout,
             isolation_level=None)
-        if self._synchronous is not None:
-            raw_connection.execute("PRAGMA synchronous = %s" %
-                (self._synchronous,))
+        configure(raw_connection, self._pragmas)
 
         # enable foreign keys
         raw_connection.execute("PRAGMA foreign_keys = ON;")
@@ -0,0 +1,48 @@
+from time import time
+import sys, logging
+
+# Records how long each subsystem took to import and initialize, for
+# tuning startup. Modules that are only needed on first use (download
+# backends, libtorrent, feedparser) are imported through import_module()
+# so their cost shows up here whenever it is paid.
+class StartupReport(object):
+
+    def __init__(self):
+        self.created = time()
+        self.finished = None
+        self.timings = []
+
+    def record(self, name, elapsed, kind='init'):
+        self.timings.append({'name': name, 'kind': kind,
+            'elapsed': round(elapsed * 1000, 1), 'at': round(time() - self.created, 3)})
+
+    # Calls func(*args) and records its running time under name
+    def measure(self, name, func, *args, **kwargs):
+        started = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(name, time() - started)
+
+    def import_module(self, name):
+        if name in sys.modules:
+            return sys.modules[name]
+        started = time()
+        __import__(name)
+        self.record(name, time() - started, 'import')
+        return sys.modules[name]
+
+    def finish(self):
+        self.finished = time()
+        logging.info('Started in %.2fs: %s' % (self.finished - self.created,
+            ', '.join(['%s %s %.1fms' % (t['kind'], t['name'], t['elapsed'])
+                for t in self.timings])))
+
+    def get_report(self):
+        total = None
+        if self.finished:
+            total = round(self.finished - self.created, 3)
+        return {'total': total, 'subsystems': list(self.timings)}
+
+# Shared by the whole process
+report = StartupReport()
@@ -0,0 +1,154 @@
+from downpour.core.net import get_interface
+from downpour.download import Status
+from twisted.internet import task, threads
+from storm import Undef
+import os, socket, logging
+
+# Running download totals, updated from DownloadIndex change events so
+# that reading them is O(1). Totals are kept globally (key None) and for
+# each user.
+class StatusAggregator(object):
+
+    fields = ('downloads', 'active_downloads', 'queued_downloads',
+        'queuedsize', 'queueddone', 'downloadrate', 'uploadrate',
+        'connections')
+
+    watched = ('status', 'active', 'size', 'downloaded', 'user_id',
+        'downloadrate', 'uploadrate', 'connections')
+
+    def __init__(self, index):
+        self.totals = {None: self.empty()}
+        index.add_listener(self)
+
+    def empty(self):
+        return dict([(f, 0) for f in self.fields])
+
+    def get_totals(self, user_id=None):
+        if user_id in self.totals:
+            return self.totals[user_id]
+        return self.empty()
+
+    def added(self, d):
+        self.apply(d.user_id, self.contribution(d), 1)
+
+    def removed(self, d):
+        self.apply(d.user_id, self.contribution(d), -1)
+
+    def changed(self, d, name, old_value, new_value):
+        if not name in self.watched:
+            return
+        if name == 'user_id':
+            self.apply(old_value, self.contribution(d), -1)
+            self.apply(new_value, self.contribution(d), 1)
+        else:
+            self.apply(d.user_id, self.contribution(d, name, old_value), -1)
+            self.apply(d.user_id, self.contribution(d), 1)
+
+    def apply(self, user_id, contribution, sign):
+        keys = [None]
+        if user_id is not None:
+            keys.append(user_id)
+        for key in keys:
+            if not key in self.totals:
+                self.totals[key] = self.empty()
+            totals = self.totals[key]
+            for f in contribution:
+                totals[f] += sign * contribution[f]
+
+    # What a download adds to the totals, optionally with one attribute
+    # overridden by its previous value
+    def contribution(self, d, name=None, value=None):
+        def get(attr):
+            if attr == name:
+                v = value
+            else:
+                v = getattr(d, attr)
+            if v is None or v is Undef:
+                return 0
+            return v
+        c = self.empty()
+        c['downloads'] = 1
+        if get('size'):
+            c['queuedsize'] = get('size')
+            c['queueddone'] = get('downloaded')
+        if get('active'):
+            c['active_downloads'] = 1
+        if get('status') == Status.QUEUED:
+            c['queued_downloads'] = 1
+        c['downloadrate'] = get('downloadrate')
+        c['uploadrate'] = get('uploadrate')
+        c['connections'] = get('connections')
+        return c
+
+# Samples disk usage and host addresses in a worker thread, so status
+# requests never block the reactor on statvfs() or DNS lookups
+class HostSampler(object):
+
+    def __init__(self, manager, interval=60):
+        self.manager = manager
+        self.interval = interval
+        self.sampling = False
+        self.loop = None
+        self.sample = {
+            'host': socket.gethostname(),
+            'diskfree': 0,
+            'diskfreepct': 0,
+            'userdiskfree': 0,
+            'userdiskfreepct': 0
+        }
+
+    def start(self):
+        self.loop = task.LoopingCall(self.refresh)
+        self.loop.start(self.interval, True)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def get_sample(self):
+        return self.sample
+
+    def refresh(self):
+        if self.sampling:
+            return
+        self.sampling = True
+        dfr = threads.deferToThread(self.read,
+            self.manager.get_work_directory(),
+            self.manager.get_user_directory(),
+            self.manager.get_option(('downpour', 'interface'), '0.0.0.0'))
+        dfr.addCallback(self.sampled)
+        dfr.addErrback(self.sample_failed)
+
+    def sampled(self, sample):
+        self.sampling = False
+        self.sample = sample
+
+    def sample_failed(self, failure):
+        self.sampling = False
+        logging.error('Host status sampling failed: %s' % failure.getErrorMessage())
+
+    # Runs in a worker thread
+    def read(self, workdir, userdir, interface):
+        sample = {}
+
+        s = os.statvfs(workdir)
+        sample['diskfree'] = s.f_bfree * s.f_bsize
+        sample['diskfreepct'] = (float(s.f_bfree) / s.f_blocks) * 100
+
+        s = os.statvfs(userdir)
+        sample['userdiskfree'] = s.f_bfree * s.f_bsize
+        sample['userdiskfreepct'] = (float(s.f_bfree) / s.f_blocks) * 100
+
+        try:
+            interface = get_interface(interface)
+            if interface == '0.0.0.0':
+                # Load IPs for local host
+                ips = [i[4][0] for i in socket.getaddrinfo(socket.gethostname(), None)]
+                ips = filter(lambda ip: ip[:4] != '127.' and ip[:2] != '::', ips)
+                interface = ', '.join(dict(map(lambda i: (i,1), ips)).keys())
+        except IOError as ioe:
+            interface = 'disconnected'
+
+        sample['host'] = '%s (%s)' % (socket.gethostname(), interface)
+
+        return sample
@@ -0,0 +1,112 @@
+from twisted.internet import reactor
+from time import time
+import logging
+
+# Per-thread CPU time, where the runtime has it. Process CPU time
+# (time.clock()) would also count libtorrent's own threads.
+try:
+    from time import thread_time
+except ImportError:
+    thread_time = None
+
+# Periodic calls whose interval follows the current activity level. The
+# mode function is asked for the level after every call, and the next
+# call is scheduled with the interval for that level, e.g.
+#
+#   AdaptiveLoop('status', update, get_mode,
+#       {'idle': 10.0, 'active': 2.0, 'busy': 1.0})
+#
+# Without a mode function the default level's interval is always used.
+# wake() runs the call on the next reactor turn, for event-driven work.
+# Calls are timed in wall clock time, and in CPU time of the reactor
+# thread where thread_time is available. details can return extra
+# statistics for get_stats().
+class AdaptiveLoop(object):
+
+    def __init__(self, name, func, mode, intervals, default='active',
+            details=None):
+        self.name = name
+        self.func = func
+        self.mode = mode
+        self.intervals = intervals
+        self.default = default
+        self.details = details
+        self.pending = None
+        self.running = False
+        self.interval = intervals[default]
+        self.calls = 0
+        self.wakeups = 0
+        self.cpu = 0.0
+        self.wall = 0.0
+        self.max_wall = 0.0
+        loops.append(self)
+
+    def start(self, now=True):
+        self.running = True
+        self.schedule(0 if now else self.interval)
+
+    def stop(self):
+        self.running = False
+        if self.pending and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+
+    def schedule(self, delay):
+        if self.pending and self.pending.active():
+            self.pending.cancel()
+        self.pending = reactor.callLater(delay, self.call)
+
+    def wake(self):
+        if self.running and not (self.pending and self.pending.active() and
+                self.pending.getTime() <= reactor.seconds()):
+            self.wakeups += 1
+            self.schedule(0)
+
+    def call(self):
+        self.pending = None
+        started = time()
+        cpu = thread_time and thread_time()
+        try:
+            self.func()
+        except Exception as e:
+            logging.error('%s loop failed: %s' % (self.name, e))
+        if thread_time:
+            self.cpu += thread_time() - cpu
+        elapsed = time() - started
+        self.wall += elapsed
+        self.max_wall = max(self.max_wall, elapsed)
+        self.calls += 1
+        if self.running:
+            self.interval = self.intervals.get(self.get_mode(), self.interval)
+            self.schedule(self.interval)
+
+    def get_mode(self):
+        if self.mode is None:
+            return self.default
+        try:
+            return self.mode()
+        except Exception:
+            return self.default
+
+    def get_stats(self):
+        calls = self.calls or 1
+        stats = {'name': self.name,
+                'mode': self.get_mode(),
+                'interval': self.interval,
+                'calls': self.calls,
+                'wakeups': self.wakeups,
+                'wall': round(self.wall * 1000, 1),
+                'wall_per_call': round(self.wall * 1000 / calls, 3),
+                'max_wall': round(self.max_wall * 1000, 3)}
+        if thread_time:
+            stats['cpu'] = round(self.cpu * 1000, 1)
+            stats['cpu_per_call'] = round(self.cpu * 1000 / calls, 3)
+        if self.details:
+            stats['details'] = self.details()
+        return stats
+
+# All loops created in this process, for status reporting
+loops = []
+
+def get_stats():
+    return [l.get_stats() for l in loops if l.running]
@@ -40,11 +40,48 @@ class DownloadClientFactory:
 
         return dc
 
-class DownloadClient:
+# Answers state queries for a download from its status alone, so
+# download lists can be rendered without instantiating a client
+class DownloadState:
 
     capabilities = Capabilities.NONE
 
-    def __init__(self, download, manager, directory=tempfile.gettempdir()):
+    def __init__(self, download, capabilities=Capabilities.NONE):
+        self.download = download
+        self.capabilities = capabilities
+
+    def can_upload(self):
+        return (self.capabilities & Capabilities.UPLOAD)
+
+    def is_running(self):
+        return self.download.status == Status.RUNNING or \
+            self.download.status == Status.SEEDING
+
+    def is_finished(self):
+        return self.download.progress == 100
+
+    def is_startable(self):
+        return not self.is_running() and \
+            (self.download.status == Status.QUEUED or \
+                self.download.status == Status.STOPPED or \
+                self.download.status == Status.FAILED or \
+                (self.download.status == Status.COMPLETED and \
+                    (self.capabilities & Capabilities.UPLOAD)))
+
+    def is_stoppable(self):
+        return self.is_running() or \
+            self.download.status == Status.LOADING or \
+            self.download.status == Status.STARTING or \
+            self.download.status == Status.STOPPING
+
+class DownloadClient(DownloadState):
+
+    capabilities = Capabilities.NONE
+
+    # prepared is the result of prepare() for this download's metadata,
+    # if it was computed ahead of time
+    def __init__(self, download, manager, directory=tempfile.gettempdir(),
+            prepared=None):
         self.download = download
         self.manager = manager
         self.directory = directory
@@ -59,6 +96,13 @@ class DownloadClient:
         if not os.access(directory, os.R_OK):
             raise OSError('Could not write to download directory %s' % directory)
 
+    # Expensive processing of download metadata that doesn't need the
+    # reactor (e.g. parsing), run in a thread pool when sessions are
+    # resumed at startup
+    @staticmethod
+    def prepare(metadata):
+        return None
+
     def callback(self, new_mimetype=False):
         self.deferred.callback(new_mimetype)
 
@@ -99,27 +143,3 @@ class DownloadClient:
         return ({'path': self.download.filename,
                  'size': self.download.size,
                  'progress': self.download.progress},)
-
-    def can_upload(self):
-        return (self.capabilities & Capabilities.UPLOAD)
-
-    def is_running(self):
-        return self.download.status == Status.RUNNING or \
-            self.download.status == Status.SEEDING
-
-    def is_finished(self):
-        return self.download.progress == 100
-
-    def is_startable(self):
-        return not self.is_running() and \
-            (self.download.status == Status.QUEUED or \
-                self.download.status == Status.STOPPED or \
-                self.download.status == Status.FAILED or \
-                (self.download.status == Status.COMPLETED and \
-                    (self.capabilities & Capabilities.UPLOAD)))
-
-    def is_stoppable(self):
-        return self.is_running() or \
-            self.download.status == Status.LOADING or \
-            self.download.status == Status.STARTING or \
-            self.download.status == Status.STOPPING
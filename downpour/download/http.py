@@ -12,7 +12,7 @@ class HTTPDownloadClient(DownloadClient):
     def start(self):
         self.original_mimetype = self.download.mime_type
         self.download.status = Status.STARTING
-        bucketFilter = ThrottledBucketFilter(0, self.manager.get_download_rate_filter())
+        bucketFilter = ThrottledBucketFilter(self.download_rate, self.manager.get_download_rate_filter())
         factoryFactory = lambda url, *a, **kw: HTTPManagedDownloader(str(self.download.url),
                                     os.path.join(self.directory, self.download.filename),
                                     statusCallback=DownloadStatus(self.download),
@@ -35,7 +35,9 @@ class HTTPDownloadClient(DownloadClient):
 
     def set_download_rate(self, rate):
         self.download_rate = rate
-        self.factory.setRateLimit(rate)
+        # Not connected yet, limit is applied in start()
+        if hasattr(self, 'factory'):
+            self.factory.setRateLimit(rate)
 
     def get_files(self):
         return ({'path': self.download.filename,
@@ -0,0 +1,45 @@
+from downpour.core import startup
+from downpour.download import Capabilities
+
+# Download clients by mimetype and URL scheme. Clients are registered by
+# class name and imported the first time a download needs one, so e.g.
+# libtorrent isn't loaded until there is a torrent to work on. Their
+# capabilities are registered too, to answer state queries without
+# importing the client.
+mimetypes = {}
+protocols = {}
+capabilities = {}
+classes = {}
+
+def register_mimetype(mimetype, name, caps=Capabilities.NONE):
+    mimetypes[mimetype] = name
+    capabilities[name] = caps
+
+def register_protocol(scheme, name, caps=Capabilities.NONE):
+    protocols[scheme] = name
+    capabilities[name] = caps
+
+def get_name(mimetype=None, scheme=None):
+    if mimetype and mimetype in mimetypes:
+        return mimetypes[mimetype]
+    if scheme and scheme in protocols:
+        return protocols[scheme]
+    return None
+
+def get_class(name):
+    if not name in classes:
+        module, cls = name.rsplit('.', 1)
+        classes[name] = getattr(startup.report.import_module(module), cls)
+    return classes[name]
+
+def get_capabilities(name):
+    return capabilities.get(name, Capabilities.NONE)
+
+torrent = 'downpour.download.torrent.LibtorrentClient'
+torrent_caps = Capabilities.MULTICONN|Capabilities.UPLOAD
+http = 'downpour.download.http.HTTPDownloadClient'
+
+register_mimetype('application/x-bittorrent', torrent, torrent_caps)
+register_protocol('magnet', torrent, torrent_caps)
+register_protocol('http', http)
+register_protocol('https', http)
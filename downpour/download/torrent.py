@@ -1,88 +1,259 @@
-from downpour.core import VERSION
+from downpour.core import VERSION, startup, timers
 from downpour.core.net import get_interface
 from downpour.download import *
-from twisted.internet import defer, task, reactor
+from downpour.download import tuning
+from twisted.internet import defer, reactor
 from twisted.web import client
 from twisted.python import failure
 import libtorrent as lt
-import os, marshal, math, sys, socket, logging, zlib, time
+import os, marshal, math, sys, socket, logging, zlib, time, threading
 
 class LibtorrentManager:
 
-    def __init__(self):
+    # Alert categories the clients handle, others are never generated
+    # unless enabled with the "torrent_alerts" option
+    default_alerts = 'error,storage,status'
+
+    def __init__(self, manager=None):
+        self.manager = manager
         self.session = lt.session()
         self.session.listen_on(6881, 6891)
-        self.session.set_alert_mask(
-            lt.alert.category_t.error_notification |
-            lt.alert.category_t.storage_notification |
-            lt.alert.category_t.status_notification |
-            lt.alert.category_t.progress_notification |
-            lt.alert.category_t.performance_warning)
+        self.session.set_alert_mask(self.get_alert_mask())
         self.torrents = {}
-        self.limits_updated = False
-
-        settings = lt.session_settings()
-        # TODO: set upload ratio settings, rate limits, etc
-        settings.user_agent = 'Downpour/%s libtorrent/%d.%d' % (VERSION,
-                            lt.version_major, lt.version_minor)
-        # settings.share_ratio_limit = float(self.manager.get_setting('upload_ratio', 0))
-        self.session.set_settings(settings)
-
-        # Update torrent status
-        self.status_update = task.LoopingCall(self.status_update)
-        self.status_update.start(2.0)
-        # Process generated alerts
-        self.alert_monitor = task.LoopingCall(self.process_alerts)
-        self.alert_monitor.start(2.0)
-        # Update rate / connection limits
-        self.limit_update = task.LoopingCall(self.limit_update)
-        self.limit_update.start(5.0)
+        # (alert name, handler) by alert class, and [count, seconds]
+        # spent handling them by alert name
+        self.alert_dispatch = {}
+        self.alert_stats = {}
+        self.session_limits = None
+        self.delta_updates = hasattr(self.session, 'post_torrent_updates')
+
+        # Session tuning, see download.tuning. Rate limits are set by
+        # limit_update(), seed ratios by the clients.
+        self.profile = None
+        self.apply_profile()
+        if manager:
+            manager.application.settings.subscribe(u'torrent_profile',
+                self.profile_changed)
+
+        # Loops slow down while nothing is transferring and speed up while
+        # torrents are starting, checking or finishing, see get_mode()
+        self.mode = 'idle'
+        self.status_loop = timers.AdaptiveLoop('torrent status',
+            self.status_update, self.get_mode, self.intervals['status'],
+            details=lambda: {'profile': self.profile})
+        self.status_loop.start()
+        self.limit_loop = timers.AdaptiveLoop('torrent limits',
+            self.limit_update, self.get_mode, self.intervals['limits'])
+        self.limit_loop.start()
+        # Alerts are processed when libtorrent signals them, polling is
+        # only a fallback
+        self.alert_waiter = None
+        self.alert_loop = timers.AdaptiveLoop('torrent alerts',
+            self.process_alerts, self.get_mode, self.intervals['alerts'],
+            details=self.get_alert_stats)
+        if self.watch_alerts():
+            self.alert_loop.intervals = self.intervals['alerts_notified']
+        self.alert_loop.start()
+
+        # Periodic resume data, see ResumeCheckpointer
+        interval = 300
+        budget = 4096
+        if manager:
+            interval = int(manager.get_option(('downpour', 'resume_checkpoint_interval'), interval))
+            budget = int(manager.get_option(('downpour', 'resume_checkpoint_kb'), budget))
+        self.checkpointer = ResumeCheckpointer(self, interval, budget * 1024)
+        if interval:
+            self.checkpointer.start()
+
+    # Seconds between loop calls by activity mode
+    intervals = {
+        'status': {'idle': 10.0, 'active': 2.0, 'busy': 1.0},
+        'limits': {'idle': 30.0, 'active': 5.0, 'busy': 5.0},
+        'alerts': {'idle': 5.0, 'active': 2.0, 'busy': 0.5},
+        'alerts_notified': {'idle': 30.0, 'active': 10.0, 'busy': 5.0}
+    }
+
+    # Statuses of torrents that need close attention
+    busy_statuses = (Status.LOADING, Status.STARTING, Status.STOPPING)
+
+    def get_mode(self):
+        return self.mode
+
+    # Only torrents whose status changed are in the alert, so only those
+    # have their derived values (health, ETA, seed progress) recomputed
+    def state_updated(self, alert, alert_type=None):
+        for status in alert.status:
+            ih = str(status.handle.info_hash())
+            if ih in self.torrents:
+                try:
+                    self.torrents[ih].update_status(status)
+                except Exception as e:
+                    pass
+        return True
 
+    # With post_torrent_updates() libtorrent only reports torrents whose
+    # status changed since the last call, in a state_update_alert (see
+    # state_updated()). Older bindings query every torrent.
     def status_update(self):
-        try:
-            for t in self.torrents:
-                self.torrents[t].update_status()
-        except Exception as e:
-            pass
+        if self.delta_updates:
+            self.session.post_torrent_updates()
+        mode = 'idle'
+        for t in self.torrents.values():
+            if not self.delta_updates:
+                try:
+                    t.update_status()
+                except Exception as e:
+                    pass
+            d = t.download
+            if d.status in self.busy_statuses or \
+                    (d.status == Status.RUNNING and d.progress >= 99):
+                mode = 'busy'
+            elif mode == 'idle' and d.status in (Status.RUNNING, Status.SEEDING):
+                mode = 'active'
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        if mode != self.mode:
+            logging.debug('Torrent session is now %s' % mode)
+            self.mode = mode
+
+    # Torrent added or removed, check on it right away
+    def activity(self):
+        self.set_mode('busy')
+        self.status_loop.wake()
+        self.limit_loop.wake()
+
+    # Wake the alert loop from libtorrent's alert notification if the
+    # bindings have one, otherwise from a thread blocked in
+    # wait_for_alert(). Returns False if alerts can only be polled.
+    def watch_alerts(self):
+        if hasattr(self.session, 'set_alert_notify'):
+            # Called on a libtorrent thread, must not call into the session
+            self.session.set_alert_notify(
+                lambda: reactor.callFromThread(self.alert_loop.wake))
+            return True
+        if hasattr(self.session, 'wait_for_alert'):
+            self.alert_waiter = AlertWaiter(self)
+            self.alert_waiter.start()
+            return True
+        return False
 
+    # Per-torrent limits are set on the handles by the clients (see
+    # LibtorrentClient.apply_limits()), the session only enforces the
+    # global limits from settings
     def limit_update(self):
-        if self.limits_updated:
-            dlrate = 0
-            ulrate = 0
-            conns = 0
-
-            for t in self.torrents:
-                dlrate += self.torrents[t].download_rate
-                ulrate += self.torrents[t].upload_rate
-                conns += self.torrents[t].max_connections
-
-            if dlrate:
-                self.session.set_download_rate_limit(dlrate)
-            else:
-                self.session.set_download_rate_limit(-1)
-
-            if ulrate:
-                self.session.set_upload_rate_limit(ulrate)
+        if not self.manager:
+            return
+        limits = (self.manager.get_int_setting('download_rate') * 1024,
+            self.manager.get_int_setting('upload_rate') * 1024,
+            self.manager.get_int_setting('connection_limit'))
+        if limits != self.session_limits:
+            self.session.set_download_rate_limit(limits[0] or -1)
+            self.session.set_upload_rate_limit(limits[1] or -1)
+            self.session.set_max_connections(limits[2] or -1)
+            self.session_limits = limits
+
+    def get_profile_name(self):
+        name = 'default'
+        if self.manager:
+            name = self.manager.get_option(('downpour', 'torrent_profile'), name)
+            name = self.manager.get_setting(u'torrent_profile') or name
+        return str(name)
+
+    # Builds session settings from the selected profile and any
+    # "torrent_<field>" options, and applies them to the running session
+    def apply_profile(self):
+        name = self.get_profile_name()
+        if not name in tuning.profiles:
+            logging.warn('Unknown torrent profile %s, using defaults' % name)
+        profile = tuning.get_profile(name)
+        settings = getattr(lt, profile['preset'], lt.session_settings)()
+        values = dict(profile['settings'])
+        if self.manager:
+            values.update(tuning.get_overrides(
+                self.manager.application.options.get('downpour', {})))
+        for field in values:
+            if hasattr(settings, field):
+                try:
+                    enum = getattr(lt, tuning.enums.get(field, ''), None)
+                    setattr(settings, field, tuning.convert(
+                        getattr(settings, field), values[field], enum))
+                except Exception as e:
+                    logging.warn('Invalid torrent setting %s=%s: %s' % (field, values[field], e))
             else:
-                self.session.set_upload_rate_limit(-1)
-
-            if conns:
-                self.session.set_max_connections(conns)
+                logging.warn('Unknown torrent setting %s' % field)
+        settings.user_agent = 'Downpour/%s libtorrent/%d.%d' % (VERSION,
+                            lt.version_major, lt.version_minor)
+        self.session.set_settings(settings)
+        # set_settings() also replaced the global rate and connection
+        # limits, so put them back
+        self.session_limits = None
+        self.limit_update()
+        self.profile = name
+        logging.info('Applied torrent session profile %s' % name)
+
+    def profile_changed(self, name, old_value, new_value):
+        self.apply_profile()
+
+    # Category names from the "torrent_alerts" option, e.g.
+    # "error,storage,status,tracker" (see lt.alert.category_t)
+    def get_alert_mask(self):
+        names = self.default_alerts
+        if self.manager:
+            names = self.manager.get_option(('downpour', 'torrent_alerts'), names)
+        mask = 0
+        for name in names.split(','):
+            name = name.strip()
+            category = getattr(lt.alert.category_t, name, None)
+            if category is None:
+                category = getattr(lt.alert.category_t, '%s_notification' % name, None)
+            if category is None:
+                logging.warn('Unknown torrent alert category: %s' % name)
             else:
-                self.session.set_max_connections(-1)
-
-            self.limits_updated = False
-
-    def process_alerts(self):
-        sys.stdout.flush()
+                mask |= int(category)
+        return mask
+
+    # All pending alerts in one call where the bindings support it
+    def pop_alerts(self):
+        if hasattr(self.session, 'pop_alerts'):
+            return self.session.pop_alerts()
+        alerts = []
         alert = self.session.pop_alert()
         while alert:
-            sys.stdout.flush()
-            alert_type = str(type(alert)).split("'")[1].split(".")[-1]
-            if not (hasattr(alert, 'handle') and self.dispatch_alert(alert, alert_type)):
-                #logging.debug("GLOBAL: %s: %s" % (alert_type, alert.message()))
-                pass
+            alerts.append(alert)
             alert = self.session.pop_alert()
+        return alerts
+
+    def process_alerts(self):
+        try:
+            for alert in self.pop_alerts():
+                cls = alert.__class__
+                if cls in self.alert_dispatch:
+                    (name, handler) = self.alert_dispatch[cls]
+                else:
+                    (name, handler) = self.alert_dispatch[cls] = self.get_alert_handler(cls)
+                started = time.time()
+                try:
+                    handler(alert, name)
+                except Exception as e:
+                    logging.error('Failed to handle %s: %s' % (name, e))
+                stats = self.alert_stats.get(name)
+                if stats is None:
+                    stats = self.alert_stats[name] = [0, 0.0]
+                stats[0] += 1
+                stats[1] += time.time() - started
+        finally:
+            if self.alert_waiter:
+                self.alert_waiter.processed()
+
+    # Session-wide alerts are handled here, torrent alerts by their client
+    def get_alert_handler(self, cls):
+        name = cls.__name__
+        if name == 'state_update_alert':
+            return (name, self.state_updated)
+        if hasattr(cls, 'handle'):
+            return (name, self.dispatch_alert)
+        return (name, self.ignore_alert)
 
     def dispatch_alert(self, alert, alert_type):
         if alert.handle.is_valid():
@@ -91,6 +262,13 @@ class LibtorrentManager:
                 return self.torrents[ih].handle_alert(alert, alert_type)
         return False
 
+    def ignore_alert(self, alert, alert_type):
+        return False
+
+    def get_alert_stats(self):
+        return dict([(name, {'count': s[0], 'time': round(s[1] * 1000, 1)})
+            for (name, s) in self.alert_stats.items()])
+
     # Pass calls through
     def add_magnet(self, client, url, params):
         handle = lt.add_magnet_uri(self.session, url, params)
@@ -98,6 +276,7 @@ class LibtorrentManager:
         if ih in self.torrents:
             raise Exception('Duplicate torrent')
         self.torrents[ih] = client
+        self.activity()
         return handle
 
     # Pass calls through
@@ -107,6 +286,7 @@ class LibtorrentManager:
         if ih in self.torrents:
             raise Exception('Duplicate torrent')
         self.torrents[ih] = client
+        self.activity()
         return handle
 
     def remove_torrent(self, t):
@@ -115,6 +295,7 @@ class LibtorrentManager:
             if ih in self.torrents:
                 self.session.remove_torrent(t.torrent, 1)
                 del self.torrents[ih]
+                self.activity()
 
     # Set comm interface (useful for routing torrent traffic over VPN, etc)
     def listen(self, interface=None):
@@ -124,17 +305,159 @@ class LibtorrentManager:
         else:
             self.session.listen_on(6881, 6891)
 
-# Single session manager
-lt_manager = LibtorrentManager()
+# Blocks in wait_for_alert() on its own thread and wakes the alert loop
+# on the reactor. Waits for the alerts to be popped before waiting again.
+class AlertWaiter(threading.Thread):
+
+    def __init__(self, manager):
+        threading.Thread.__init__(self, name='downpour-alerts')
+        self.setDaemon(True)
+        self.manager = manager
+        self.ready = threading.Event()
+        self.ready.set()
+        self.running = True
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def run(self):
+        while self.running:
+            self.ready.wait()
+            if self.manager.session.wait_for_alert(500) is not None and self.running:
+                self.ready.clear()
+                reactor.callFromThread(self.manager.alert_loop.wake)
+
+    def processed(self):
+        self.ready.set()
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+
+# Asks torrents for fresh resume data on a rolling schedule, so a crash
+# doesn't force a full recheck on restart. Only torrents that report
+# need_save_resume_data() are asked, starting after the last torrent of
+# the previous round, until the estimated size of their resume data
+# reaches the per-interval budget. The answers are written together in
+# one transaction.
+class ResumeCheckpointer(object):
+
+    # Assumed size of resume data not seen yet
+    estimate = 16384
+
+    def __init__(self, manager, interval=300, budget=4 * 1024 * 1024):
+        self.manager = manager
+        self.budget = budget
+        self.cursor = None
+        self.waiting = set()
+        self.pending = {}
+        self.sizes = {}
+        self.checkpoints = 0
+        self.requested = 0
+        self.written = 0
+        self.bytes = 0
+        self.loop = timers.AdaptiveLoop('resume checkpoints', self.checkpoint,
+            None, {'active': interval}, details=self.get_stats)
+
+    def start(self):
+        self.loop.start(False)
+
+    def stop(self):
+        self.loop.stop()
+
+    def needs_save(self, client):
+        handle = client.torrent
+        if not handle or not handle.is_valid() or not handle.has_metadata():
+            return False
+        if hasattr(handle, 'need_save_resume_data'):
+            return handle.need_save_resume_data()
+        return not handle.is_paused()
+
+    def checkpoint(self):
+        # Answers that never came (e.g. the torrent was removed)
+        self.flush()
+        self.waiting.clear()
+
+        hashes = sorted(self.manager.torrents.keys())
+        if self.cursor is not None:
+            later = [ih for ih in hashes if ih > self.cursor]
+            hashes = later + [ih for ih in hashes if ih <= self.cursor]
+        used = 0
+        for ih in hashes:
+            client = self.manager.torrents[ih]
+            if not self.needs_save(client):
+                continue
+            size = self.sizes.get(ih, self.estimate)
+            if self.waiting and used + size > self.budget:
+                break
+            used += size
+            self.cursor = ih
+            self.waiting.add(client)
+            client.torrent.save_resume_data()
+        self.requested += len(self.waiting)
+        self.checkpoints += 1
+
+    # Called with resume data from a save_resume_data_alert, returns
+    # False if the checkpointer didn't ask for it
+    def saved(self, client, data):
+        if not client in self.waiting:
+            return False
+        self.waiting.discard(client)
+        self.pending[client] = data
+        if not self.waiting:
+            self.flush()
+        return True
+
+    def failed(self, client):
+        if not client in self.waiting:
+            return False
+        self.waiting.discard(client)
+        if not self.waiting:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return
+        committer = None
+        for client, data in self.pending.items():
+            if client.torrent:
+                client.download.resume_data = data
+                self.sizes[str(client.torrent.info_hash())] = len(data)
+                self.written += 1
+                self.bytes += len(data)
+                committer = client.manager
+        self.pending = {}
+        if committer:
+            committer.commit()
+
+    def get_stats(self):
+        return {'checkpoints': self.checkpoints,
+                'requested': self.requested,
+                'written': self.written,
+                'bytes': self.bytes,
+                'waiting': len(self.waiting)}
+
+# Single session manager, created when the first torrent needs it so
+# the session doesn't open ports or poll while there are no torrents
+lt_manager = None
+
+# manager (a downpour manager) supplies configuration to a new session
+def get_lt_manager(manager=None):
+    global lt_manager
+    if lt_manager is None:
+        lt_manager = startup.report.measure('libtorrent session',
+            LibtorrentManager, manager)
+    return lt_manager
 
 class LibtorrentClient(DownloadClient):
     
     capabilities = Capabilities.MULTICONN|Capabilities.UPLOAD
 
-    def __init__(self, download, manager, directory):
+    def __init__(self, download, manager, directory, prepared=None):
         DownloadClient.__init__(self, download, manager, directory)
-        if download.metadata:
-            self.torrent_info = lt.torrent_info(lt.bdecode(self.download.metadata))
+        if prepared is None and download.metadata_key:
+            prepared = LibtorrentClient.prepare(download.metadata)
+        if prepared is not None:
+            self.torrent_info = prepared
             download.description = unicode(self.torrent_info.name())
             if not download.size:
                 download.size = self.torrent_info.total_size()
@@ -145,6 +468,12 @@ class LibtorrentClient(DownloadClient):
         self.dfm = {}
         self.autostop = True
 
+    @staticmethod
+    def prepare(metadata):
+        if not metadata:
+            return None
+        return lt.torrent_info(lt.bdecode(metadata))
+
     # Set comm interface (useful for routing torrent traffic over VPN, etc)
     def rebind(self, errorTriggered=False):
 
@@ -156,9 +485,9 @@ class LibtorrentClient(DownloadClient):
         try:
             logging.debug('Rebinding torrent manager to interface %s' % interface);
             ip = get_interface(interface)
-            if lt_manager.session.is_paused():
-                lt_manager.session.resume()
-            lt_manager.listen(interface)
+            if get_lt_manager(self.manager).session.is_paused():
+                get_lt_manager(self.manager).session.resume()
+            get_lt_manager(self.manager).listen(interface)
             if not self.torrent is None and not ip is None:
                 self.torrent.use_interface(ip)
             self.rebinding = False
@@ -166,7 +495,7 @@ class LibtorrentClient(DownloadClient):
             if errorTriggered:
                 logging.info('The specified network interface is not available: %s' % interface)
             self.rebinding = True
-            lt_manager.session.pause()
+            get_lt_manager(self.manager).session.pause()
             reactor.callLater(30.0, self.rebind)
             
     def start(self):
@@ -174,17 +503,18 @@ class LibtorrentClient(DownloadClient):
         if 'state_changed_alert' in self.dfm:
             raise Exception('An operation is already in progress')
         self.dfm['state_changed_alert'] = defer.Deferred()
-        if not self.torrent and not self.download.metadata:
+        if not self.torrent and not self.download.metadata_key:
             if self.download.url:
                 # Don't try to re-fetch until an attempt is done
                 if self.download.status != Status.LOADING:
                     if self.download.url.startswith('magnet:'):
                         params = { 'save_path': str(self.directory), 'auto_managed': True }
-                        resdata = None
-                        if self.download.resume_data:
-                            params['resdata'] = marshal.loads(self.download.resume_data)
+                        resdata = self.download.resume_data
+                        if resdata:
+                            params['resdata'] = marshal.loads(resdata)
                         self.download.status = Status.LOADING
-                        self.torrent = lt_manager.add_magnet(self, str(self.download.url), params)
+                        self.torrent = get_lt_manager(self.manager).add_magnet(self, str(self.download.url), params)
+                        self.apply_limits()
                         self.dfm['metadata_received_alert'] = defer.Deferred()
                         self.dfm['metadata_received_alert'].addCallback(self.magnet_loaded)
                         self.dfm['metadata_failed_alert'] = defer.Deferred()
@@ -213,11 +543,14 @@ class LibtorrentClient(DownloadClient):
             self.download.description = unicode(self.torrent_info.name())
         try:
             if not self.torrent:
-                resdata = None
-                if self.download.resume_data:
-                    resdata = marshal.loads(self.download.resume_data)
-                self.torrent = lt_manager.add_torrent(self, self.torrent_info, self.directory, resume_data=resdata)
+                resdata = self.download.resume_data
+                if resdata:
+                    resdata = marshal.loads(resdata)
+                else:
+                    resdata = None
+                self.torrent = get_lt_manager(self.manager).add_torrent(self, self.torrent_info, self.directory, resume_data=resdata)
                 self.torrent.auto_managed(True)
+                self.apply_limits()
             self.rebind()
         except Exception as e:
             dfr = self.dfm['state_changed_alert']
@@ -262,37 +595,9 @@ class LibtorrentClient(DownloadClient):
         # logging.debug("TORRENT: %s: %s, %s" % (alert_type, alert.what(), alert.message()))
         if alert_type == 'torrent_resumed_alert':
             alert_type = 'state_changed_alert'
-        if alert_type == 'torrent_finished_alert':
-            self.download.status = Status.COMPLETED
-            #self.download.status_message = None
-            self.check_finished()
-        elif alert_type == 'torrent_paused_alert':
-            if alert.handle.is_valid():
-                error = alert.handle.status().error
-                if error:
-                    self.torrent.auto_managed(False)
-                    self.download.active = False
-                    self.download.status = Status.FAILED
-                    self.download.status_message = error
-                    self.errback(failure.Failure(Exception(error)))
-            self.update_status()
-        elif alert_type == 'save_resume_data_alert':
-            self.download.resume_data = marshal.dumps(alert.resume_data)
-        elif alert_type == 'save_resume_data_failed_alert':
-            self.download.resume_data = None
-        elif alert_type == 'state_changed_alert':
-            self.update_status()
-        elif alert_type == 'tracker_error_alert':
-            logging.debug("TORRENT: %s: %s, %s" % (alert_type, alert.what(), alert.message()))
-            if 'Cannot assign requested address' in alert.message():
-                self.rebind(True)
-            self.update_status()
-
-        elif alert_type == 'scrape_failed_alert':
-            logging.debug("TORRENT: %s: %s, %s" % (alert_type, alert.what(), alert.message()))
-            # Only alert I can find that provides warning of a network interface going down
-            if 'Cannot assign requested address' in alert.message():
-                self.rebind(True)
+        handler = self.alert_handlers.get(alert_type)
+        if handler:
+            handler(self, alert, alert_type)
 
         if alert_type in self.dfm:
             self.dfm[alert_type].callback(self)
@@ -300,27 +605,91 @@ class LibtorrentClient(DownloadClient):
 
         return True
 
+    def torrent_finished(self, alert, alert_type):
+        self.download.status = Status.COMPLETED
+        #self.download.status_message = None
+        self.check_finished()
+
+    def torrent_paused(self, alert, alert_type):
+        if alert.handle.is_valid():
+            error = alert.handle.status().error
+            if error:
+                self.torrent.auto_managed(False)
+                self.download.active = False
+                self.download.status = Status.FAILED
+                self.download.status_message = error
+                self.errback(failure.Failure(Exception(error)))
+        self.update_status()
+
+    # Periodic checkpoints are written by the checkpointer in batches,
+    # resume data saved on stop is written right away
+    def resume_data_saved(self, alert, alert_type):
+        data = marshal.dumps(alert.resume_data)
+        checkpointer = get_lt_manager(self.manager).checkpointer
+        if 'save_resume_data_alert' in self.dfm or \
+                not checkpointer.saved(self, data):
+            self.download.resume_data = data
+
+    def resume_data_failed(self, alert, alert_type):
+        checkpointer = get_lt_manager(self.manager).checkpointer
+        if 'save_resume_data_alert' in self.dfm or \
+                not checkpointer.failed(self):
+            self.download.resume_data = None
+
+    def state_changed(self, alert, alert_type):
+        self.update_status()
+
+    def tracker_error(self, alert, alert_type):
+        logging.debug("TORRENT: %s: %s, %s" % (alert_type, alert.what(), alert.message()))
+        if 'Cannot assign requested address' in alert.message():
+            self.rebind(True)
+        self.update_status()
+
+    def scrape_failed(self, alert, alert_type):
+        logging.debug("TORRENT: %s: %s, %s" % (alert_type, alert.what(), alert.message()))
+        # Only alert I can find that provides warning of a network interface going down
+        if 'Cannot assign requested address' in alert.message():
+            self.rebind(True)
+
+    # Handlers by alert name, see handle_alert()
+    alert_handlers = {
+        'torrent_finished_alert': torrent_finished,
+        'torrent_paused_alert': torrent_paused,
+        'save_resume_data_alert': resume_data_saved,
+        'save_resume_data_failed_alert': resume_data_failed,
+        'state_changed_alert': state_changed,
+        'tracker_error_alert': tracker_error,
+        'scrape_failed_alert': scrape_failed
+    }
+
     def remove(self):
         self.dfm['state_changed_alert'] = defer.Deferred()
         if self.torrent:
-            lt_manager.remove_torrent(self)
+            get_lt_manager(self.manager).remove_torrent(self)
             self.torrent = None
         return self.dfm['state_changed_alert']
 
+    # Limits are applied to the torrent handle, 0 means unlimited
     def set_download_rate(self, rate):
-        if rate != self.download_rate:
-            lt_manager.limits_updated = True
         self.download_rate = rate
+        if self.torrent and self.torrent.is_valid():
+            self.torrent.set_download_limit(rate or -1)
 
     def set_upload_rate(self, rate):
-        if rate != self.upload_rate:
-            lt_manager.limits_updated = True
         self.upload_rate = rate
+        if self.torrent and self.torrent.is_valid():
+            self.torrent.set_upload_limit(rate or -1)
 
     def set_max_connections(self, limit):
-        if limit != self.max_connections:
-            lt_manager.limits_updated = True
         self.max_connections = limit
+        if self.torrent and self.torrent.is_valid():
+            self.torrent.set_max_connections(limit or -1)
+
+    # Apply current limits to a newly added torrent
+    def apply_limits(self):
+        self.set_download_rate(self.download_rate)
+        self.set_upload_rate(self.upload_rate)
+        self.set_max_connections(self.max_connections)
 
     def get_files(self):
         files = []
@@ -383,14 +752,17 @@ class LibtorrentClient(DownloadClient):
             self.download.metadata = data
             self.download.status = Status.QUEUED
             self.download.status_message = None
-            self.torrent_info = lt.torrent_info(lt.bdecode(self.download.metadata))
+            self.torrent_info = lt.torrent_info(lt.bdecode(data))
             self.download.description = unicode(self.torrent_info.name())
             self.start_real()
 
-    def update_status(self):
+    # Refresh the download from a torrent_status, queried from the handle
+    # if not given (e.g. from a state_update_alert)
+    def update_status(self, status=None):
         if self.torrent and self.torrent.is_valid():
-            status = self.torrent.status()
-            paused = self.torrent.is_paused()
+            if status is None:
+                status = self.torrent.status()
+            paused = status.paused
             self.download.size = status.total_wanted
             self.download.downloaded = int(status.total_wanted_done)
             self.download.downloadrate = float(status.download_payload_rate)
@@ -402,7 +774,7 @@ class LibtorrentClient(DownloadClient):
             self.download.status_message = unicode(status.error)
 
             if self.download.downloaded > 0:
-                ulratio = float(self.manager.get_setting('upload_ratio', 0))
+                ulratio = self.get_seed_ratio()
                 currratio = self.download.uploaded / self.download.downloaded
                 uploadtarget = self.download.size * ulratio
                 if uploadtarget > 0:
@@ -471,8 +843,14 @@ class LibtorrentClient(DownloadClient):
             self.stop()
             self.callback()
 
+    # Download's own seed ratio if set, otherwise the upload_ratio setting
+    def get_seed_ratio(self):
+        if self.download.seed_ratio is not None:
+            return self.download.seed_ratio
+        return self.manager.get_float_setting('upload_ratio')
+
     def seed_requirement_met(self):
-        ulratio = float(self.manager.get_setting('upload_ratio', 0))
+        ulratio = self.get_seed_ratio()
         return (self.download.uploaded / self.download.downloaded) >= ulratio
 
     def get_extended_status(self, name):
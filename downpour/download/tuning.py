@@ -0,0 +1,85 @@
+# Libtorrent session tuning profiles, selected with the "torrent_profile"
+# setting (the option of the same name gives the default). Each profile
+# starts from one of libtorrent's presets and adjusts it. Any
+# session_settings field can be overridden in downpour.cfg with a
+# "torrent_<field>" option, e.g. torrent_cache_size=4096.
+#
+# Enumerated fields take value names (e.g. "rate_based_choker"), and
+# cache_size is in 16 KiB blocks.
+profiles = {
+    'default': {
+        'description': 'Libtorrent defaults (desktop)',
+        'preset': 'session_settings',
+        'settings': {}
+    },
+    'low-memory': {
+        'description': 'Low memory (small devices, few torrents)',
+        'preset': 'min_memory_usage',
+        'settings': {
+            'active_downloads': 2,
+            'active_seeds': 4,
+            'active_limit': 10,
+            'max_peerlist_size': 500,
+            'max_paused_peerlist_size': 100,
+            'close_redundant_connections': True
+        }
+    },
+    'seedbox': {
+        'description': 'High-performance seedbox (many torrents, fast disks)',
+        'preset': 'high_performance_seed',
+        'settings': {
+            'cache_size': 32768,
+            'cache_expiry': 300,
+            'use_read_cache': True,
+            'send_buffer_low_watermark': 1024 * 1024,
+            'send_buffer_watermark': 8 * 1024 * 1024,
+            'send_buffer_watermark_factor': 150,
+            'aio_threads': 4,
+            'choking_algorithm': 'rate_based_choker',
+            'seed_choking_algorithm': 'fastest_upload',
+            'active_downloads': 20,
+            'active_seeds': 1000,
+            'active_limit': 2000,
+            'dont_count_slow_torrents': True
+        }
+    }
+}
+
+# Options that start with "torrent_" but aren't session settings
+reserved = ('torrent_profile', 'torrent_alerts')
+
+# Enumerated fields, by the libtorrent enum their value names belong to.
+# The bindings expose these fields as plain ints, so the names can't be
+# found from the current value.
+enums = {
+    'choking_algorithm': 'choking_algorithm_t',
+    'seed_choking_algorithm': 'seed_choking_algorithm_t',
+    'disk_cache_algorithm': 'disk_cache_algo_t',
+    'mixed_mode_algorithm': 'bandwidth_mixed_algo_t'
+}
+
+def get_profile(name):
+    return profiles.get(name, profiles['default'])
+
+# Session settings from "torrent_<field>" options
+def get_overrides(options):
+    return dict([(name[8:], options[name]) for name in options
+        if name.startswith('torrent_') and not name in reserved])
+
+# Converts a value from the profile or config file to the type of the
+# field's current value. enum is the field's Boost.Python enum type, if
+# it has one (see enums).
+def convert(current, value, enum=None):
+    if not isinstance(value, basestring):
+        return value
+    if isinstance(current, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    # Boost.Python enums have a names dict
+    names = getattr(enum or type(current), 'names', None)
+    if names:
+        return names[value]
+    if isinstance(current, (int, long)):
+        return int(value)
+    if isinstance(current, float):
+        return float(value)
+    return value
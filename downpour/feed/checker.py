@@ -1,6 +1,6 @@
-from downpour.core import models, organizer
+from downpour.core import models, organizer, startup
 from twisted.internet import threads
-import feedparser, logging
+import logging
 from time import time, mktime, localtime
 from datetime import datetime
 from dateutil.parser import parse as parsedate
@@ -20,6 +20,8 @@ def update_feeds(feeds, application):
         modified = None
         if not f.modified is None:
             modified = localtime(f.modified)
+        # Only loaded once there are feeds to check
+        feedparser = startup.report.import_module('feedparser')
         d = threads.deferToThread(feedparser.parse, f.url, etag=f.etag,
                 modified=modified)
         manager = application.get_manager(f.user)
@@ -39,7 +41,22 @@ def feed_parsed(parsed, feeds, manager, feed):
         feed.modified = mktime(parsed.modified)
     if 'etag' in parsed:
         feed.etag = unicode(parsed.etag)
-    manager.store.commit()
+    # Write out items saved by earlier checks before taking the snapshot
+    manager.commit()
+    manager.flush()
+
+    dfr = manager.application.get_data_access().snapshot(load_feed_items, feed.id)
+    dfr.addCallback(feed_items_loaded, parsed, feeds, manager, feed)
+    dfr.addErrback(feed_parse_failed, feeds, manager, feed)
+
+# Previously seen items of a feed as (id, guid, link, title, updated)
+# tuples, runs in a database snapshot thread (see core.dbaccess)
+def load_feed_items(store, feed_id):
+    return list(store.find((models.FeedItem.id, models.FeedItem.guid,
+        models.FeedItem.link, models.FeedItem.title, models.FeedItem.updated),
+        models.FeedItem.feed_id == feed_id))
+
+def feed_items_loaded(pastitems, parsed, feeds, manager, feed):
 
     # Check entries for new downloads
     items = parsed.entries
@@ -53,10 +70,11 @@ def feed_parsed(parsed, feeds, manager, feed):
     seen_items = []
 
     # Prime previously-seen item map to avoid duplicate downloads
-    pastitems = manager.store.find(models.FeedItem,
-        models.FeedItem.feed_id == feed.id)
+    known = {}
+    processed = set()
     for pi in pastitems:
-        epdef = get_episode_definition(pi)
+        known[pi[1]] = pi
+        epdef = episode_definition(feed.name, pi[2], pi[3])
         seen_items.append(epdef)
         if epdef['s'] and int(epdef['s']) > latest_season:
             latest_season = int(epdef['s'])
@@ -66,13 +84,25 @@ def feed_parsed(parsed, feeds, manager, feed):
                 latest_episode = int(epdef['e'])
 
     for e in items:
+        # Duplicate entries aren't in the snapshot yet
+        if e.id in processed:
+            continue
+        processed.add(e.id)
+
+        if feed.queue_size > 0 and item_count >= feed.queue_size:
+            break;
+        item_count += 1
+
         do_update = False
         updated = mktime(e.updated_parsed)
         season = 0
 
-        item = manager.store.find(models.FeedItem,
-            models.FeedItem.feed_id == feed.id,
-            models.FeedItem.guid == e.id).one()
+        # Unchanged items don't need to be loaded at all
+        item = None
+        if e.id in known:
+            if known[e.id][4] == updated:
+                continue
+            item = manager.store.get(models.FeedItem, known[e.id][0])
 
         # Check for enclosures
         link = e.link
@@ -160,10 +190,6 @@ def feed_parsed(parsed, feeds, manager, feed):
             item.download = d
             manager.add_download(d)
 
-        item_count += 1
-        if feed.queue_size > 0 and item_count >= feed.queue_size:
-            break;
-
     if has_new:
         manager.application.fire_event('feed_updated', feed)
         if 'modified' in parsed:
@@ -171,7 +197,7 @@ def feed_parsed(parsed, feeds, manager, feed):
         else:
             feed.last_update = time()
 
-    manager.store.commit()
+    manager.commit()
 
     # Process the next feed
     if len(feeds):
@@ -261,7 +287,7 @@ def clean_download_feed(d, app):
                     i.download.files.remove(f)
             i.removed = True
 
-        manager.store.commit()
+        manager.commit()
 
 def seen(m, items):
     for i in items:
@@ -274,18 +300,21 @@ def seen(m, items):
     return False
 
 def get_episode_definition(item):
-    ed = { 'd': None, 's': None, 'e': None, 'z': item.feed.name }
+    return episode_definition(item.feed.name, item.link, item.title)
+
+def episode_definition(name, link, title):
+    ed = { 'd': None, 's': None, 'e': None, 'z': name }
     rl = (
         re.compile(r's(?P<s>[0-9]{1,2})\W?e(?P<e>[0-9]{1,2})', re.IGNORECASE),
         re.compile(r'(?P<s>[0-9]{1,2})x(?P<e>[0-9]{1,2})', re.IGNORECASE),
         re.compile(r'(?P<d>[0-9\-\.]{8,})', re.IGNORECASE)
     )
     for r in rl:
-        match = r.search(item.link)
+        match = r.search(link)
         if match:
             ed.update(match.groupdict())
         else:
-            match = r.search(item.title)
+            match = r.search(title)
             if match:
                 ed.update(match.groupdict())
     if ed['d']:
@@ -298,7 +327,7 @@ def get_episode_definition(item):
 def feed_parse_failed(failure, feeds, manager, feed):
     feed.last_update = time()
     feed.last_error = unicode(failure.getErrorMessage())
-    manager.store.commit()
+    manager.commit()
 
     if len(feeds):
         update_feeds(feeds, manager.application)
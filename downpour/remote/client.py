@@ -18,6 +18,9 @@ class DownpourRemote:
     def get_status(self):
         return self.json_request('status')
 
+    def get_event_stats(self):
+        return self.json_request('events')
+
     def get_downloads(self):
         return self.json_request('downloads')
 
@@ -63,6 +66,15 @@ class DownpourRemote:
                 'media_type': media_type
             })
 
+    # action is one of start, stop, restart, remove or add; add takes
+    # a list of {'url': ..., 'media_type': ...} dicts as downloads
+    def bulk_downloads(self, action, ids=None, downloads=None):
+        return self.json_request('downloads/bulk', {
+                'action': action,
+                'ids': ids or [],
+                'downloads': downloads or []
+            })
+
     def get_feeds(self):
         return self.json_request('feeds')
 
@@ -86,6 +86,7 @@ class Save(common.AuthenticatedResource):
             manager = self.get_manager(request)
             # Save to database
             manager.store.commit()
+            manager.application.fire_event('user_updated', account.user)
             request.redirect('/account/saved')
             request.finish()
             return server.NOT_DONE_YET
@@ -117,6 +117,24 @@ class Resource(resource.Resource):
             request.setHeader('Content-type', 'text/html; charset=UTF-8')
         return t.render(defaults).encode('utf8')
 
+    # Render a template once dfr fires, its result (a dict) is merged into
+    # the context. Used with the application's database snapshots.
+    def render_template_deferred(self, dfr, template, request, context, content_type = None):
+        def render(result):
+            context.update(result)
+            request.write(self.render_template(template, request, context, content_type))
+            request.finish()
+        def failed(failure):
+            request.setHeader('Status', '500 Server Error')
+            request.write(self.render_template('errors/error.html', request, {
+                'title': 'Server Error',
+                'message': failure.getErrorMessage()
+                }))
+            request.finish()
+        dfr.addCallback(render)
+        dfr.addErrback(failed)
+        return server.NOT_DONE_YET
+
 class AuthenticatedResource(Resource):
 
     def render(self, request, *args):
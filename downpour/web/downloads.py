@@ -1,10 +1,27 @@
 from downpour.web import common
 from downpour.core import models, organizer
 from downpour import download
+from downpour.download import registry
 from twisted.web import server
 from twisted.internet import defer
 from storm import expr
-import libtorrent as lt
+
+# Recently completed downloads as plain dicts, runs in a database
+# snapshot thread (see core.dbaccess)
+def load_history(store, user_id=None, limit=10):
+    conditions = [models.Download.completed > 0,
+        models.Download.user_id == models.User.id]
+    if user_id is not None:
+        conditions.append(models.Download.user_id == user_id)
+    rows = store.find((models.Download.description, models.Download._size,
+        models.Download.media_type, models.Download.completed,
+        models.User.username), *conditions
+        ).order_by(expr.Desc(models.Download.completed))[:limit]
+    return [{'description': r[0],
+             'size': r[1],
+             'media_type': r[2],
+             'completed': r[3],
+             'user': {'username': r[4]}} for r in rows]
 
 class Root(common.AuthenticatedResource):
 
@@ -62,30 +79,24 @@ class Root(common.AuthenticatedResource):
                     cmp = self.numcmp(True)
             downloads.sort(cmp, key, reverse)
 
-        history = None
         user = self.get_user(request)
-        if user.admin:
-            history = manager.store.find(models.Download,
-                models.Download.completed > 0
-                ).order_by(expr.Desc(models.Download.completed))[:10]
-        else:
-            history = manager.store.find(models.Download,
-                models.Download.completed > 0,
-                models.Download.user == user
-                ).order_by(expr.Desc(models.Download.completed))[:10]
+        user_id = None
+        if not user.admin:
+            user_id = user.id
+        dfr = request.application.get_data_access().snapshot(load_history, user_id, 10)
+        dfr.addCallback(lambda history: {'history': history})
 
         context = {'title': 'Downloads',
                    'status': manager.get_status(),
                    'downloads': downloads,
-                   'history': history,
                    'mediatypes': organizer.get_media_types(),
                    'sort': sort,
                    'sortdir': sortdir,
-                   'clientFactory': lambda id: manager.get_download_client(id, True),
+                   'clientFactory': manager.get_download_state,
                    'statuscode': download.Status,
                    'statusdesc': download.Status.descriptions
                    }
-        return self.render_template('downloads/index.html', request, context)
+        return self.render_template_deferred(dfr, 'downloads/index.html', request, context)
 
 class StatusJS(common.AuthenticatedResource):
 
@@ -93,7 +104,7 @@ class StatusJS(common.AuthenticatedResource):
         manager = self.get_manager(request)
         context = {'status': manager.get_status(),
                    'downloads': manager.get_downloads(),
-                   'clientFactory': lambda id: manager.get_download_client(id, True),
+                   'clientFactory': manager.get_download_state,
                    'statuscode': download.Status,
                    'statusdesc': download.Status.descriptions
                    }
@@ -121,7 +132,7 @@ class AddTorrent(common.AuthenticatedResource):
             d = models.Download()
             d.mime_type = u'application/x-bittorrent'
             d.metadata = request.args['torrent'][0]
-            ti = lt.torrent_info(lt.bdecode(d.metadata))
+            ti = registry.get_class(registry.torrent).prepare(request.args['torrent'][0])
             d.description = unicode(ti.name())
             d.size = int(ti.total_size())
             self.get_manager(request).add_download(d)
@@ -162,9 +173,8 @@ class Cleanup(common.AuthenticatedResource):
 
     def render_GET(self, request):
         manager = self.get_manager(request)
-        for d in manager.get_downloads():
-            if d.status == download.Status.COMPLETED and d.imported and not d.active:
-                manager.remove_download(d.id)
+        manager.bulk_remove([d.id for d in manager.get_downloads()
+            if d.status == download.Status.COMPLETED and d.imported and not d.active])
         request.redirect('/downloads')
         request.finish()
         return server.NOT_DONE_YET
@@ -177,34 +187,27 @@ class Bulk(common.AuthenticatedResource):
 
     def render_POST(self, request):
         manager = self.get_manager(request)
-        postrun = None
 
         def finish(result):
-            if postrun:
-                postrun()
             request.redirect('/downloads')
             request.finish()
 
-        def startall():
-            [manager.start_download(int(id)) for id in ids]
-
         if 'id' in request.args and 'action' in request.args:
             action = request.args['action'][0]
             ids = request.args['id']
-            dl = []
+            dfl = None
 
             if action == 'start':
-                startall()
+                dfl = manager.bulk_start(ids)
             elif action == 'stop':
-                dl = [manager.stop_download(int(id)) for id in ids]
+                dfl = manager.bulk_stop(ids)
             elif action == 'restart':
-                dl = [manager.stop_download(int(id)) for id in ids]
-                postrun = startall
+                dfl = manager.bulk_stop(ids)
+                dfl.addCallback(lambda x: manager.bulk_start(ids))
             elif action == 'remove':
-                dl = [manager.remove_download(int(id)) for id in ids]
+                dfl = manager.bulk_remove(ids)
 
-            if len(dl):
-                dfl = defer.DeferredList(dl, consumeErrors=True)
+            if dfl:
                 dfl.addCallback(finish)
             else:
                 finish(None)
@@ -219,23 +222,16 @@ class History(common.AuthenticatedResource):
         self.putChild('', self)
 
     def render_GET(self, request):
-        manager = self.get_manager(request)
         user = self.get_user(request)
-        downloads = None
-        if user.admin:
-            downloads = manager.store.find(models.Download,
-                models.Download.completed > 0
-                ).order_by(expr.Desc(models.Download.completed))[:30]
-        else:
-            downloads = manager.store.find(models.Download,
-                models.Download.completed > 0,
-                models.Download.user == user
-                ).order_by(expr.Desc(models.Download.completed))[:30]
+        user_id = None
+        if not user.admin:
+            user_id = user.id
+        dfr = request.application.get_data_access().snapshot(load_history, user_id, 30)
+        dfr.addCallback(lambda downloads: {'downloads': downloads})
 
         context = {'title': 'Last 30 Downloads',
-                   'downloads': downloads,
                    'mediatypes': organizer.get_media_types()}
-        return self.render_template('downloads/history.html', request, context)
+        return self.render_template_deferred(dfr, 'downloads/history.html', request, context)
 
 class Detail(common.AuthenticatedResource):
 
@@ -265,9 +261,7 @@ class Detail(common.AuthenticatedResource):
     def render_GET(self, request):
         manager = self.get_manager(request)
         dl = manager.get_download(self.id)
-        store = request.application.get_store()
-        user = self.get_user(request)
-        libs = store.find(models.Library, models.Library.user_id == user.id)
+        libs = manager.get_libraries()
         if dl.mime_type:
             template = 'downloads/detail_%s.html' % dl.mime_type.replace('/', '_')
         else:
@@ -351,7 +345,11 @@ class Update(common.AuthenticatedResource):
     def render_POST(self, request):
         manager = self.get_manager(request)
         converters = {
-            'media_type': lambda v: unicode(v)
+            'media_type': lambda v: unicode(v),
+            'priority': lambda v: int(v),
+            'max_rate': lambda v: int(v or 0),
+            'max_upload_rate': lambda v: int(v or 0),
+            'seed_ratio': lambda v: float(v) if v.strip() else None
         }
         # Updated object from form
         for k in request.args:
@@ -359,9 +357,13 @@ class Update(common.AuthenticatedResource):
             if hasattr(self.download, k) and k in converters:
                 setattr(self.download, k, converters[k](request.args[k][0]))
         # Reprocess library import if it is already finished
-        if self.download.imported:
+        if 'media_type' in request.args and self.download.imported:
             manager.process_download(self.download,
                 manager.get_download_client(self.download.id))
+        if 'priority' in request.args:
+            request.application.manager.schedule_auto_queue()
+        if 'max_rate' in request.args or 'max_upload_rate' in request.args:
+            request.application.manager.allocator.allocate()
         manager.store.commit()
         request.redirect('/downloads')
         request.finish()
@@ -127,7 +127,6 @@ class Save(common.AuthenticatedResource):
         if not feed:
             feed = models.Feed()
             feed.user = self.get_user(request)
-            manager.store.add(feed)
 
         # Updated object from form
         for k in request.args:
@@ -138,7 +137,11 @@ class Save(common.AuthenticatedResource):
             feed.auto_clean = False
         if not 'active' in request.args:
             feed.active = False
-        manager.store.commit()
+        if self.feed:
+            manager.store.commit()
+            manager.application.fire_event('feed_updated', feed)
+        else:
+            manager.add_feed(feed)
 
         # Update immediately if requested
         if 'updatenow' in request.args:
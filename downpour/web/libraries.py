@@ -53,6 +53,7 @@ class Save(common.AuthenticatedResource):
             libraries[mediatype[i]].pattern = unicode(pattern[i])
             libraries[mediatype[i]].keepall = (keepall[i] == '1')
         manager.store.commit()
+        manager.application.fire_event('library_updated', self.get_user(request))
         request.redirect('/')
         request.finish()
         return server.NOT_DONE_YET
@@ -4,7 +4,6 @@ from downpour import download
 from twisted.web import server
 from twisted.internet import defer
 from storm import expr
-import libtorrent as lt
 import json, base64
 
 class JSONRemoteResource(common.Resource):
@@ -64,7 +63,11 @@ class JSONRemoteResource(common.Resource):
 
     def get_download_dict(self, manager, dl, show_files=False):
 
-        client = manager.get_download_client(dl.id, True)
+        # Only detail requests need the real client, for its file list
+        if show_files:
+            client = manager.get_download_client(dl.id, True)
+        else:
+            client = manager.get_download_state(dl.id)
 
         feedid = None
         if dl.feed:
@@ -92,6 +95,10 @@ class JSONRemoteResource(common.Resource):
             'status': download.Status.descriptions[dl.status],
             'status_code': dl.status,
             'status_message': dl.status_message,
+            'priority': dl.priority,
+            'max_rate': dl.max_rate or 0,
+            'max_upload_rate': dl.max_upload_rate or 0,
+            'seed_ratio': dl.seed_ratio,
             'size': dl.size,
             'progress': dl.progress,
             'downloaded': dl.downloaded,
@@ -106,14 +113,18 @@ class JSONRemoteResource(common.Resource):
             'imported': dl.imported,
             'elapsed': int(dl.elapsed),
             'timeleft': int(dl.timeleft),
-            'running': (client.is_running() and True),
-            'startable': (client.is_startable() and True),
-            'stoppable': (client.is_stoppable() and True),
-            'finished': (client.is_finished() and True)
+            'running': (client is not None and client.is_running() and True),
+            'startable': (client is not None and client.is_startable() and True),
+            'stoppable': (client is not None and client.is_stoppable() and True),
+            'finished': (client is not None and client.is_finished() and True)
         };
 
+        allocation = manager.application.manager.allocator.get_allocation(dl.id)
+        if allocation:
+            dldict['allocation'] = allocation
+
         if show_files:
-            dldict['files'] = [f for f in client.get_files() if client]
+            dldict['files'] = client and client.get_files() or []
         
         return dldict
 
@@ -122,6 +133,7 @@ class Root(JSONRemoteResource):
     def __init__(self):
         JSONRemoteResource.__init__(self)
         self.putChild('status', Status())
+        self.putChild('events', Events())
         self.putChild('downloads', Downloads())
         self.putChild('feeds', Feeds())
 
@@ -143,6 +155,21 @@ class Status(JSONRemoteResource):
 
         return result
 
+# Listener statistics are for administrators only
+class Events(JSONRemoteResource):
+
+    def render(self, request, *args):
+        if self.is_logged_in(request) and not self.get_user(request).admin:
+            request.setHeader('Status', '401 Not Authorized')
+            request.write(json.dumps({ 'error': 'Not authorized' },
+                indent=4))
+            request.finish()
+            return server.NOT_DONE_YET
+        return JSONRemoteResource.render(self, request, *args)
+
+    def call(self, manager, params=None):
+        return manager.application.events.get_stats()
+
 class Downloads(JSONRemoteResource):
 
     def __init__(self):
@@ -150,6 +177,7 @@ class Downloads(JSONRemoteResource):
         self.putChild('', self)
         self.putChild('add', AddDownload())
         self.putChild('addtorrent', AddTorrent())
+        self.putChild('bulk', BulkDownloads())
 
     def getChild(self, path, request):
         if path in self.children:
@@ -188,8 +216,7 @@ class AddDownload(JSONRemoteResource):
         else:
             raise Exception('URL not specified')
 
-        manager.add_download(dl)
-        return dl.id
+        return manager.add_download(dl)
 
 class AddTorrent(JSONRemoteResource):
 
@@ -205,8 +232,50 @@ class AddTorrent(JSONRemoteResource):
         else:
             raise Exception('Torrent data not specified')
 
-        manager.add_download(dl)
-        return dl.id
+        return manager.add_download(dl)
+
+class BulkDownloads(JSONRemoteResource):
+
+    def call(self, manager, params):
+
+        if not params or not 'action' in params:
+            raise Exception('Action not specified')
+
+        action = params['action']
+        ids = params.get('ids', [])
+
+        if action == 'add':
+            downloads = []
+            for p in params.get('downloads', []):
+                dl = models.Download()
+                if 'url' in p:
+                    dl.url = p['url']
+                elif 'metadata' in p:
+                    dl.mime_type = u'application/x-bittorrent'
+                    dl.metadata = base64.decodestring(p['metadata'])
+                    dl.description = u'Imported torrent'
+                else:
+                    raise Exception('URL not specified')
+                if 'media_type' in p:
+                    dl.media_type = p['media_type']
+                downloads.append(dl)
+            manager.bulk_add(downloads)
+            # Ids are assigned by the flush in bulk_add(); downloads that
+            # were rejected have none
+            return [dl.id for dl in downloads]
+        elif action == 'start':
+            manager.bulk_start(ids)
+        elif action == 'stop':
+            manager.bulk_stop(ids)
+        elif action == 'restart':
+            dfl = manager.bulk_stop(ids)
+            dfl.addCallback(lambda x: manager.bulk_start(ids))
+        elif action == 'remove':
+            manager.bulk_remove(ids)
+        else:
+            raise Exception('Unknown action "%s"' % action)
+
+        return True
 
 class StopDownload(JSONRemoteResource):
 
@@ -260,11 +329,25 @@ class UpdateDownload(JSONRemoteResource):
 
     def call(self, manager, params):
         dl = manager.get_download(self.id)
-        if params['media_type']:
+        if 'media_type' in params and params['media_type']:
             dl.media_type = unicode(params['media_type'])
-        # Reprocess library import if it is already imported
-        if dl.imported:
-            manager.process_download(dl, manager.get_download_client(dl.id))
+            # Reprocess library import if it is already imported
+            if dl.imported:
+                manager.process_download(dl, manager.get_download_client(dl.id))
+        if 'priority' in params:
+            dl.priority = int(params['priority'])
+            manager.application.manager.schedule_auto_queue()
+        if 'seed_ratio' in params:
+            if params['seed_ratio'] is None or params['seed_ratio'] == '':
+                dl.seed_ratio = None
+            else:
+                dl.seed_ratio = float(params['seed_ratio'])
+        if 'max_rate' in params or 'max_upload_rate' in params:
+            if 'max_rate' in params:
+                dl.max_rate = int(params['max_rate'] or 0)
+            if 'max_upload_rate' in params:
+                dl.max_upload_rate = int(params['max_upload_rate'] or 0)
+            manager.application.manager.allocator.allocate()
         manager.store.commit()
         return True
 
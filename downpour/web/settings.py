@@ -1,5 +1,6 @@
 from downpour.web import common
-from downpour.core import models
+from downpour.core import scheduling
+from downpour.download import tuning
 from twisted.web import server
 
 class Root(common.AdminResource):
@@ -10,28 +11,24 @@ class Root(common.AdminResource):
         self.putChild('save', Save())
 
     def render_GET(self, request):
-        manager = self.get_manager(request)
-        settings = manager.store.find(models.Setting)
-        setdict = {}
-        if settings.count():
-            setdict = dict(zip([s.name for s in settings], [s.value for s in settings]))
         context = {
             'title': 'Settings',
-            'settings': setdict
+            'settings': request.application.settings.all(),
+            'policies': scheduling.policies,
+            'profiles': tuning.profiles,
+            'torrent_profile': request.application.get_setting(u'torrent_profile') or
+                request.application.get_option(('downpour', 'torrent_profile'), 'default')
         }
         return self.render_template('settings/index.html', request, context)
 
 class Save(common.AdminResource):
 
     def render_POST(self, request):
+        # Bandwidth filters and the download queue pick up changed
+        # settings through their subscriptions
         for s in request.args:
             request.application.set_setting(unicode(s), unicode(request.args[s][0]))
 
-        # Force bandwidth filters to reload
-        manager = self.get_manager(request)
-        manager.get_upload_rate_filter()
-        manager.get_download_rate_filter()
-
         request.redirect('/')
         request.finish()
         return server.NOT_DONE_YET
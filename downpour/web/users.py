@@ -124,6 +124,8 @@ class Save(common.AdminResource):
         if not 'share_enabled' in request.args:
             user.share_enabled = False
         manager.store.commit()
+        if self.user:
+            manager.application.fire_event('user_updated', user)
 
         request.redirect('/users')
         request.finish()
@@ -138,6 +140,7 @@ class Delete(common.AdminResource):
     def render_GET(self, request):
         manager = request.application.get_manager()
         manager.store.remove(self.user)
+        manager.application.fire_event('user_removed', self.user)
         request.redirect('/users')
         request.finish()
         return server.NOT_DONE_YET